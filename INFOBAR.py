@@ -17,13 +17,12 @@
 
 import tkinter as tk
 from tkinter import filedialog, ttk
+import threading, time, queue, base64
+from collections import OrderedDict
 from pathlib import Path
-from bs4 import BeautifulSoup
-import subprocess, json, threading, statistics, time, webbrowser
-import concurrent.futures
-
-name='INFOBAR'
-version='2.0'
+from infobar_core import name, version, config, executor, search, default_resources, appFuncs, record_query, \
+    runtime_model, job_journal, scheduler
+# the shared queue, watcher and QC export modules, webbrowser and concurrent.futures are imported on first use
 
 # helper class for common gui widgets
 class Elements:
@@ -58,37 +57,6 @@ class Elements:
         self.b = tk.Label(self.master, textvariable=charVariable)
         self.b.grid(row=y_, column=x_, sticky=algn)
 
-# helper class for settings
-class config:
-    def __init__(self):
-        self.readSettings()
-        self.allocate()
-
-    def readSettings(self):
-        with open(Path(__file__).parent.absolute()/'settings.json') as settingsFile:
-            self.settings_dict = json.load(settingsFile)
-
-    def allocate(self):
-        self.icaPath = self.settings_dict["icaPath"]
-        self.prefeat_identifier = self.settings_dict['prefeat_identifier']
-        self.output_identifier = self.settings_dict['output_identifier']
-        self.user_options=self.settings_dict["user"]
-        self.default_options = self.settings_dict["defaults"]
-
-    def reverse_allocate(self):
-        self.settings_dict["icaPath"] = self.icaPath
-        self.settings_dict['prefeat_identifier'] = self.prefeat_identifier
-        self.settings_dict['output_identifier'] = self.output_identifier
-        self.settings_dict['user']=self.user_options
-
-    def writeSettings(self):
-        self.reverse_allocate()
-        with open(Path(__file__).parent.absolute()/'settings.json', 'w') as json_file:
-            json.dump(self.settings_dict, json_file)
-
-    def loadDefaults(self):
-        self.settings_dict["user"] = self.settings_dict["defaults"].copy()
-
 #-----------------------------------------------------------------------------------------------------------------------
 
 class Menubar:
@@ -98,6 +66,11 @@ class Menubar:
         self.menubar = tk.Menu(self.parent)
         self.settings = self.add_menu('Settings',
                                       commands=[("Settings", self.Settings, True), ("Quit", self.ifQuit, False)])
+        self.queue = self.add_menu('Queue', commands=[("Shared Queue Status", self.queue_status, False)])
+        self.export = None      # set by MainApp to MainArea.export_qc
+        self.verify = None      # and MainArea.verify_outputs
+        self.database = self.add_menu('Database', commands=[("Export QC Table...", self.export_qc, False),
+                                                            ("Verify Outputs", self.verify_outputs, False)])
         self.help = self.add_menu("Help", commands=[("Help", self.help, True), ("About", self.about, False)])
         self.parent.config(menu=self.menubar)
 
@@ -123,15 +96,29 @@ class Menubar:
         ab = tk.Toplevel()
         About(ab)
 
+    def queue_status(self):
+        path = self.config.queue_dir or tk.filedialog.askdirectory(title='Shared queue directory')
+        if path == '' or path == (): return
+        self.config.queue_dir = path
+        from infobar_queue import work_queue
+        QueueStatus(tk.Toplevel(), work_queue(path))
+
+    def export_qc(self):
+        if self.export is not None: self.export()
+
+    def verify_outputs(self):
+        if self.verify is not None: self.verify()
+
     def help(self):
         url = 'help/Manual.pdf'
+        import webbrowser
         webbrowser.open(url, new=1)
 
 class Settings:
     def __init__(self, parent,config):
         self.parent = parent
         self.config=config
-        self.parent.geometry('600x200')
+        self.parent.geometry('600x370')
 
         self.parent.title('Settings')
         self.icaPath = tk.StringVar()
@@ -142,9 +129,11 @@ class Settings:
         self.f2 = tk.LabelFrame(self.parent, text='Parameters')
         self.f2.grid(column=0, row=1)
         self.f3 = tk.Frame(self.parent)
-        self.f3.grid(column=0, row=2, sticky='W', pady=5)
+        self.f3.grid(column=0, row=3, sticky='W', pady=5)
         self.f4 = tk.LabelFrame(self.parent, text='File Options')
         self.f4.grid(column=1, row=1, sticky='W')
+        self.f5 = tk.LabelFrame(self.parent, text='Resources (0 = automatic)')
+        self.f5.grid(column=0, row=2, columnspan=2, sticky='W')
 
         # ICA  selection
         self.f_files = Elements(self.f1)
@@ -156,9 +145,11 @@ class Settings:
         self.tr = self.f_params.textField('tr (secs)', 5, 0, 1)
         self.D = self.f_params.textField('dim ', 5, 0, 2)
         self.den = self.f_params.textField('den', 5, 0, 3)
+        self.sweep = self.f_params.textField('den sweep', 12, 0, 4)         # e.g. nonaggr,aggr; one MELODIC run
         self.tr.insert(0,self.config.user_options[0])
         self.D.insert(0,self.config.user_options[1])
         self.den.insert(0,self.config.user_options[2])
+        self.sweep.insert(0, ','.join(self.config.sweep))
 
         # File extensions options
         self.file_options=Elements(self.f4)
@@ -167,6 +158,16 @@ class Settings:
         # Output folder identifier
         self.output_identifier = self.file_options.textField("Output Identifier", 20, 0, 1)
 
+        # Limits for concurrent ICA-AROMA jobs
+        self.f_resources = Elements(self.f5)
+        self.max_jobs = self.f_resources.textField('Max jobs', 5, 0, 0)
+        self.memory_gb = self.f_resources.textField('Memory (GB)', 5, 2, 0)
+        self.threads_per_job = self.f_resources.textField('Threads/job', 5, 0, 1)
+        self.nice = self.f_resources.textField('Nice', 5, 2, 1)
+        self.scratch_dir = self.f_resources.textField('Scratch dir', 20, 0, 2)    # local staging of outputs, '' for none
+        self.scratch_gb = self.f_resources.textField('Scratch (GB)', 5, 2, 2)
+        self.load_resources(self.config.resources)
+
         # Save and Defaults options
         self.f_save = Elements(self.f3)
         self.f_save.button('Save', self.save, '', 1, 0, 'W', 1)
@@ -181,9 +182,23 @@ class Settings:
         self.config.prefeat_identifier = self.extension_identifier.get()
         self.config.output_identifier = self.output_identifier.get()
         self.config.user_options=[self.tr.get(),self.D.get(),self.den.get()]
+        self.config.sweep = [den.strip() for den in self.sweep.get().split(',') if den.strip()]
+        try:
+            self.config.resources = {'max_jobs': int(self.max_jobs.get() or 0), 'memory_gb': float(self.memory_gb.get() or 0),
+                                     'threads_per_job': int(self.threads_per_job.get() or 1), 'nice': int(self.nice.get() or 0),
+                                     'scratch_dir': self.scratch_dir.get().strip(), 'scratch_gb': float(self.scratch_gb.get() or 0)}
+        except ValueError:
+            print('Resources must be numbers, previous values kept')
         self.config.writeSettings()
         self.parent.destroy()
 
+    def load_resources(self, resources):
+        for field, key in ((self.max_jobs, 'max_jobs'), (self.memory_gb, 'memory_gb'),
+                           (self.threads_per_job, 'threads_per_job'), (self.nice, 'nice'),
+                           (self.scratch_dir, 'scratch_dir'), (self.scratch_gb, 'scratch_gb')):
+            field.delete(0, 'end')
+            field.insert(0, resources[key])
+
     def defaults(self):
         self.config.loadDefaults()
         self.tr.delete(0, 'end')
@@ -193,6 +208,7 @@ class Settings:
         self.tr.insert(0, self.config.default_options[0])
         self.D.insert(0, self.config.default_options[1])
         self.den.insert(0, self.config.default_options[2])
+        self.load_resources(default_resources)
 
         print('Defaults loaded')
 
@@ -218,19 +234,162 @@ class About:
         lb2.grid(row=2, sticky='EW')
 
 
+
+# window with the aggregate state of a shared work queue, refreshed periodically
+# the queue directory is listed in a background thread so a slow shared filesystem does not block the GUI
+class QueueStatus:
+    def __init__(self, parent, queue, interval=5000):
+        self.parent = parent
+        self.queue = queue
+        self.interval = interval
+        self.result = None
+        self.parent.title(name+': Shared Queue')
+        self.parent.geometry('400x250')
+        self.text = tk.StringVar()
+        self.text.set(f'Reading {queue.path} ...')
+        tk.Label(self.parent, textvariable=self.text, justify='left', anchor='nw').pack(fill='both', expand=True, padx=20, pady=10)
+        self.refresh()
+
+    def refresh(self):
+        if not self.parent.winfo_exists(): return
+        if self.result is not None:
+            counts = self.result
+            lines = [f'Queue: {self.queue.path}', '', f"Pending: {counts['pending']}    Running: {counts['running']}",
+                     f"Done: {counts['done']}    Failed: {counts['failed']}", '', 'Workers:']
+            lines += [f'  {worker}: {n} running' for worker, n in sorted(counts['workers'].items())] or ['  none']
+            self.text.set('\n'.join(lines))
+            self.result = None
+        threading.Thread(target=self.read, daemon=True).start()
+        self.parent.after(self.interval, self.refresh)
+
+    def read(self):
+        self.result = self.queue.status()
+
 #-----------------------------------------------------------------------------------------------------------------------
 
-class Viewer:
+#  class for the images shown by the viewer
+#  PNG files are read by a small thread pool and kept as bytes; they are decoded into PhotoImages on the Tk thread
+#  only, as Tk objects must not be created from other threads. Both stores are LRU and bounded by size in bytes.
+class image_cache:
+    def __init__(self, ui, max_data=64 << 20, max_images=256 << 20, workers=2):
+        self.ui = ui
+        self.max_data = max_data
+        self.max_images = max_images
+        self.data = OrderedDict()       # path -> PNG bytes
+        self.data_size = 0
+        self.images = OrderedDict()     # (path, subsample) -> PhotoImage
+        self.image_size = 0
+        self.pending = set()
+        self.lock = threading.Lock()
+        import concurrent.futures
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    # PNG bytes of path, from the cache or the file system; None if it cannot be read
+    def read(self, path):
+        key = str(path)
+        with self.lock:
+            data = self.data.get(key)
+            if data is not None:
+                self.data.move_to_end(key)
+                return data
+        try:
+            with open(key, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        with self.lock:
+            if key not in self.data:
+                self.data[key] = data
+                self.data_size += len(data)
+                while self.data_size > self.max_data and len(self.data) > 1:
+                    self.data_size -= len(self.data.popitem(last=False)[1])
+        return data
+
+    # reads paths in the background and decodes them on the Tk thread once read
+    def prefetch(self, paths):
+        for path in paths:
+            key = str(path)
+            with self.lock:
+                if key in self.pending or (key, 1) in self.images: continue
+                self.pending.add(key)
+            self.pool.submit(self.fetch, key)
+
+    def fetch(self, key):
+        try:
+            if self.read(key) is not None:
+                self.ui.post(('decode', key), self.image, key)
+        finally:
+            with self.lock:
+                self.pending.discard(key)
+
+    # runs func in the background, for prefetches that first need to read something
+    def submit(self, func, *args):
+        self.pool.submit(func, *args)
+
+    # decoded image, optionally shrunk by an integer factor; Tk thread only
+    def image(self, path, subsample=1):
+        key = (str(path), subsample)
+        photo = self.images.get(key)
+        if photo is not None:
+            self.images.move_to_end(key)
+            return photo
+        if subsample > 1:
+            full = self.image(path)
+            if full is None: return None
+            photo = full.subsample(subsample)
+        else:
+            data = self.read(path)
+            if data is None: return None
+            try:
+                photo = tk.PhotoImage(data=base64.b64encode(data))
+            except tk.TclError:
+                return None
+        self.images[key] = photo
+        self.image_size += self.size(photo)
+        while self.image_size > self.max_images and len(self.images) > 1:
+            self.image_size -= self.size(self.images.popitem(last=False)[1])
+        return photo
 
-    def __init__(self,parent):
-        self.parent=parent
-        parent.protocol("WM_DELETE_WINDOW", self.do_nothing)
-        parent.minsize(300, 400)
-        self.parent.title(name+': Image Viewer')
-        self.fr=tk.Frame(parent,borderwidth=1, padx=20,pady=10)
-        self.fr.pack(fill ="both", expand = True)
+    @staticmethod
+    def size(photo):
+        return photo.width() * photo.height() * 4
+
+#  class for the image viewer window
+#  The window and its image cache are created the first time something is shown, not at startup; closing the
+#  window only hides it until the next image is shown
+class Viewer:
+    thumbnail_columns = 3
+    thumbnail_subsample = 3
+
+    def __init__(self, ui):
+        self.ui = ui
+        self.parent = None
+        self.fr = None
+        self.image_cache = None
+        self.grid_mode = False
+
+    @property
+    def cache(self):
+        if self.image_cache is None: self.image_cache = image_cache(self.ui)
+        return self.image_cache
+
+    def window(self):
+        if self.parent is None:
+            self.parent = tk.Toplevel()
+            self.parent.protocol("WM_DELETE_WINDOW", self.parent.withdraw)
+            self.parent.minsize(300, 400)
+            self.parent.title(name+': Image Viewer')
+            self.fr=tk.Frame(self.parent,borderwidth=1, padx=20,pady=10)
+            self.fr.pack(fill ="both", expand = True)
+        elif self.parent.state() == 'withdrawn':
+            self.parent.deiconify()
+
+    # empties the window, if there is one yet
+    def clear(self):
+        if self.fr is not None: self.clearFrame(self.fr)
 
     def display(self, im_list, mode):
+        self.window()
         self.clearFrame(self.fr)
 
         # Unprocessed viewer
@@ -263,16 +422,21 @@ class Viewer:
             self.scroll_viewer_setup(frame_left)
             self.scroll_viewer()
 
+    # label showing a cached image, or a note when the file cannot be read
+    def image_label(self, frame, path, subsample=1):
+        photo = self.cache.image(path, subsample)
+        if photo is None:
+            return tk.Label(frame, text=f'{Path(path).name} not found', pady=20)
+        label = tk.Label(frame, image=photo, pady=20)
+        label.photo = photo
+        return label
 
     def main_image_viewer(self, frame):
         el = Elements(frame)
         for i in range(0, len(self.main_im_list)):
             el.label1(self.labels[i], 0, 2*i, 'nesw', 1, 1)
             self.fr.rowconfigure(2*i+1, weight=1)
-            im_path = self.main_im_list[i]
-            photo = tk.PhotoImage(file=im_path)
-            label = tk.Label(frame, image=photo, pady=20)
-            label.photo = photo
+            label = self.image_label(frame, self.main_im_list[i])
             label.grid(row=2*i+1)
 
 
@@ -280,51 +444,78 @@ class Viewer:
         self.ic = len(self.IC_im_list)
         self.j = 0
         self.count = tk.StringVar()
-        self.count.set(f'{self.j + 1} of {self.ic} Motion associated independent components')
         el = Elements(fr)
         el.button('Previous', self.scroll, -1, 0, 0, 'e', 1)
         el.button('  Next  ', self.scroll, 1, 1, 0, 'w', 1)
+        el.button('Grid', self.toggle_grid, '', 3, 0, 'w', 1)
         el.label2(self.count, 2, 0, 'w')
         self.frame_scroll = tk.Frame(fr, borderwidth=1,  padx=20, pady=10)
         self.frame_scroll.grid(row=1, columnspan=10, sticky='nsew')
 
 
     def scroll(self, scr):
+        self.grid_mode = False
         self.j += scr
         if (self.j >= self.ic):
             self.j = self.ic-1
         if self.j<0:
             self.j = 0
-        self.count.set(f'{self.j + 1} of {self.ic} components')
-        self.clearFrame(self.frame_scroll)
+        self.scroll_viewer()
+
+    def toggle_grid(self):
+        self.grid_mode = not self.grid_mode
         self.scroll_viewer()
 
     def scroll_viewer(self):
-        ic_im_path = self.IC_im_list[self.j]
-        photo = tk.PhotoImage(file=ic_im_path)
-        label = tk.Label(self.frame_scroll, image=photo, pady=20)
-        label.photo = photo
+        self.clearFrame(self.frame_scroll)
+        if self.ic == 0:
+            self.count.set('No motion associated independent components')
+            return
+        if self.grid_mode:
+            self.thumbnail_viewer()
+            return
+        self.count.set(f'{self.j + 1} of {self.ic} Motion associated independent components')
+        label = self.image_label(self.frame_scroll, self.IC_im_list[self.j])
         label.grid(row=0, sticky='nsew')
+        # the components either side are likely next
+        self.cache.prefetch(self.IC_im_list[k] for k in (self.j + 1, self.j - 1, self.j + 2) if 0 <= k < self.ic)
+
+    # all components of the run at once; clicking one opens it
+    def thumbnail_viewer(self):
+        self.count.set(f'{self.ic} Motion associated independent components')
+        for k, path in enumerate(self.IC_im_list):
+            label = self.image_label(self.frame_scroll, path, self.thumbnail_subsample)
+            label.grid(row=k // self.thumbnail_columns, column=k % self.thumbnail_columns, padx=2, pady=2)
+            label.bind('<Button-1>', lambda e, k=k: self.open_component(k))
+
+    def open_component(self, k):
+        self.grid_mode = False
+        self.j = k
+        self.scroll_viewer()
 
     def clearFrame(self,frame):
         # destroy all widgets from frame
         for widget in frame.winfo_children():
            widget.destroy()
 
-    @staticmethod
-    def do_nothing():
-        pass
-
 #-----------------------------------------------------------------------------------------------------------------------
 
 class MainArea(tk.Frame):
-    def __init__(self, master, stat, viewer, config, **kwargs):
+    def __init__(self, master, stat, viewer, config, ui, **kwargs):
         tk.Frame.__init__(self, master, **kwargs)
 
         self.stat = stat
         self.viewer=viewer
         self.config=config
+        self.ui=ui
         self.overwrite = tk.IntVar()
+        self.stale_only = tk.IntVar()
+        self.watch = tk.IntVar(value=int(bool(config.watch)))
+        self.watcher = None
+        self.estimate_job = None
+        self.estimate_generation = 0
+        self.estimate_model = None  # runtime_model for estimates, read from the journal once per search or batch
+        self.active = None      # executor of the running batch
 
         self.columnconfigure(0, weight=1)
         self.rowconfigure(1, weight=1)
@@ -344,112 +535,279 @@ class MainArea(tk.Frame):
         # Individual elements
 
         # Display results and status
-        self.result_tree = result_window(self.f2, viewer, stat)
+        self.result_tree = result_window(self.f2, viewer, stat, ui)
+        self.result_tree.on_summary = self.estimate
         # Controls
         el = Elements(self.f1)
         el.button("Database", self.selectPath, '', 0, 0, tk.W + tk.E, 1)        # Selection of root directory
-        el.button("Process", self.processThreader, '', 0, 1, tk.W + tk.E, 1)    # Process all data
+        el.button("Process", self.processThreader, self.process, 0, 1, tk.W + tk.E, 1)    # Process all data
+        el.button("Resume", self.processThreader, self.resume, 0, 2, tk.W + tk.E, 1)     # Resume interrupted jobs
+        el.button("Submit", self.submit, '', 0, 3, tk.W + tk.E, 1)              # Add to shared work queue
         self.dataset = el.textField("Task/Dataset", 20, 1, 0)                   # Task or Dataset to be searched for
-        self.filters = el.textField("Filters", 20, 1, 1)                        # keywords to filter individual datasets
+        self.filters = el.textField("Filters", 20, 1, 1)                        # query filtering the results as you type
+        self.filters.bind('<KeyRelease>', self.filter_changed)
+        self.filter_job = None
         el.button("Search", self.search, '', 3, 0, tk.N + tk.S, 1)              # button press to start search
         el.button("Clear", self.result_tree.clear, '', 3, 1, tk.N, 1)           # button press to clear selection
         el.check('Overwrite', self.overwrite, 4, 1)                             # checkbox for overwite option
+        el.check('Stale only', self.stale_only, 4, 2)                           # skip outputs matching inputs and settings
+        el.check('Watch', self.watch, 4, 0)                                     # keep listed datasets current
+        el.button("Pause", self.pause, '', 5, 0, tk.W + tk.E, 1)                # stop starting new jobs
+        self.pause_button = el.b
+        el.button("Drain", self.control, 'drain', 5, 1, tk.W + tk.E, 1)         # finish running jobs, start no more
+        el.button("Cancel", self.control, 'cancel', 5, 2, tk.W + tk.E, 1)       # stop running jobs as well
+        el.label1('', 6, 0, tk.W + tk.N, 3, 1)                                  # live job counts and ETA of a batch
+        self.metrics_label = el.b
+        self.metrics_label.config(justify='left', padx=15)
+        self.watch.trace_add('write', lambda *args: self.start_watch())
 
         self.file_path=''
 
     # method for calling directory picker
     def selectPath(self):
-        self.file_path = appFuncs.selectPath(self.file_path)
+        f = tk.filedialog.askdirectory()
+        if f!='':
+            self.file_path=f
         self.stat.set('Database Selected: %s', self.file_path)
         self.result_tree.file_path = self.file_path
 
     # executed on clicking search button
     def search(self):
-        self.viewer.clearFrame(self.viewer.fr)
-        dataset = self.dataset.get()
-        identifier=f'*{dataset}*.feat'
-        if dataset=='':identifier=f'*.feat'
-        # Search for all files that match task
-        search_list = Path(self.file_path).rglob(identifier)
-        search_list = self.verify_dataset(search_list)
-        filtered_list = self.apply_filters(search_list)
-        self.result_tree.fileList = self.aggregated_list(filtered_list)
+        self.viewer.clear()
+        # Search for all preprocessed .feat folders that match task; filters are applied in memory by the result window
+        self.result_tree.fileList = search(self.file_path, self.dataset.get(), '', self.config)
+        self.estimate_model = None
+        self.result_tree.set_fd_threshold(self.config.fd_threshold)
+        self.start_watch()
         # Refresh results display
         self.result_tree.display()  # display the results
 
-    # Checks if the selected dataset is a preprocessed dataset for one individual.
-    # Filters out based on presence of a report_prestat.html file
-    @staticmethod
-    def verify_dataset(file_list):
-        fl = [dataset for dataset in file_list if (Path(dataset/'report_prestats.html').exists()) and not(Path(dataset/'cluster_zstat1.html').exists())]
-        return fl
-
-    def apply_filters(self,file_list):
-        # List of datasets as string for display purposes
-        filters = self.filters.get()
-        if len(filters) != 0:
-            filters = filters.split(";")
-            fl = [row for row in file_list if any(f in str(row) for f in filters)]
-
-        else:
-            fl = file_list
-        return fl
+    # re-filters the scanned results shortly after typing stops
+    def filter_changed(self, event=None):
+        if self.filter_job is not None: self.after_cancel(self.filter_job)
+        self.filter_job = self.after(150, self.apply_filter)
+
+    def apply_filter(self):
+        self.filter_job = None
+        self.result_tree.set_query(self.filters.get())
+
+    # expected duration of processing the rows Process would run, shown in the status bar
+    # job sizes are read from the NIfTI headers in the background, once per dataset
+    def estimate(self, records):
+        if self.estimate_job is not None: self.after_cancel(self.estimate_job)
+        self.estimate_job = self.after(300, self.start_estimate, list(records))
+
+    def start_estimate(self, records):
+        self.estimate_job = None
+        self.estimate_generation += 1
+        generation = self.estimate_generation
+        threading.Thread(target=self.run_estimate, args=(records, generation), daemon=True).start()
+
+    def run_estimate(self, records, generation):
+        if not records:
+            self.stat.set_estimate('')
+            return
+        model = self.estimate_model
+        if model is None: model = self.estimate_model = runtime_model(job_journal(self.config.journal_path))
+        durations = []
+        for record in records:
+            # a newer selection or filter takes over; the headers read so far stay cached on the records
+            if generation != self.estimate_generation: return
+            durations.append(model.seconds(record.job_cost()))
+        slots = scheduler(self.config.resources).max_jobs
+        makespan = model.makespan(durations, slots)
+        finish = time.strftime('%a %H:%M', time.localtime(time.time() + makespan))
+        self.stat.set_estimate('Process %d: ~%s on %d slots, done %s', len(records), self.duration(makespan),
+                               slots, finish)
+
+    # job counts, throughput and ETA of the running batch, refreshed every second until it ends
+    def show_metrics(self, batch):
+        m = batch.metrics.snapshot()
+        text = (f"Queued {m['queued']}   Running {m['running']}\n"
+                f"Done {m['done'] + m['skipped']}   Failed {m['failed']}   Cancelled {m['cancelled']}\n"
+                f"{m['jobs_per_hour']:.1f} jobs/h")
+        if m['active'] and m['eta_seconds']:
+            finish = time.strftime('%H:%M', time.localtime(time.time() + m['eta_seconds']))
+            text += f"   ETA {finish} ({self.duration(m['eta_seconds'])})"
+        elif not m['active']:
+            text += f"   in {self.duration(m['elapsed_seconds'])}"
+        self.metrics_label.config(text=text)
+        if self.active is batch or m['active']: self.after(1000, self.show_metrics, batch)
 
-    def aggregated_list(self, filtered_list):
-        prefix = self.config.prefeat_identifier
-        suffix = self.config.output_identifier
-        fl = []
-        iid = 0
-        for inpath in filtered_list:
-            pop=0
-            # is the resulting file a post-processed file from ICA-AROMA processed data
-            pop_i = appFuncs.postProcessed_identifier(inpath)
-            if pop_i == 0:
-                # generate output path of file
-                outpath = appFuncs.generateOutpath(inpath, prefix, suffix)
-                pvp = appFuncs.prevProcessed(outpath)
-                if pvp == 1:    pop = appFuncs.postProcessed(outpath)
-                head_motion_stats = appFuncs.headMotion_stats(inpath)
-                fl.append([inpath, outpath, head_motion_stats, pvp, pop, iid])
-                iid += 1
-        return fl
+    @staticmethod
+    def duration(seconds):
+        minutes = int(round(seconds / 60))
+        if minutes < 60: return f'{minutes} min'
+        return f'{minutes // 60} h {minutes % 60:02d} min'
 
     # Routed here from processThreader when Process button is pressed
     def process(self):
         self.stat.set('Processing...')
         queue = self.result_tree.queue()
         t1=time.perf_counter()
-        process_queue = executor(queue, self.config.icaPath, self.overwrite.get(), self.result_tree.processing_status, self.config.user_options, self.result_tree.fileList)
+        process_queue = executor(queue, self.config, self.overwrite.get(), self.result_tree.processing_status,
+                                 bool(self.stale_only.get()))
+        self.active = process_queue
+        self.ui.post(None, self.show_metrics, process_queue)
         process_queue.threader()        # put the queue on multi-threaded processing
+        self.batch_finished()
         t2 = time.perf_counter()
-        self.stat.set(f'Processing Completed in {round((t2-t1)/60)} minutes')
-
-    def processThreader(self):
+        self.stat.set(f'Processing Completed in {round((t2-t1)/60)} minutes   |   Job summary: {process_queue.summary.path}')
+
+    # (re)starts watching the listed datasets for changes on disk while Watch is checked
+    def start_watch(self):
+        self.config.watch = bool(self.watch.get())
+        if self.watcher is not None: self.watcher.stop()
+        self.watcher = None
+        if self.config.watch and self.result_tree.fileList:
+            on_change = lambda records: self.ui.post(None, self.result_tree.update_rows, records)
+            from infobar_watch import dataset_watcher
+            self.watcher = dataset_watcher(self.result_tree.fileList, on_change, self.config.fd_threshold,
+                                           self.config.watch_interval).start()
+
+    # Routed here from processThreader when Resume button is pressed: reruns unfinished jobs of the journal
+    def resume(self):
+        self.stat.set('Resuming...')
+        t1=time.perf_counter()
+        process_queue = executor(self.result_tree.fileList, self.config, 0, self.result_tree.processing_status)
+        que, exhausted = process_queue.resume_prep()
+        self.active = process_queue
+        self.ui.post(None, self.show_metrics, process_queue)
+        process_queue.threader(que)
+        self.batch_finished()
+        t2 = time.perf_counter()
+        self.stat.set(f'Resumed {len(que)} jobs in {round((t2-t1)/60)} minutes   |   {len(exhausted)} failed jobs out of retries')
+
+    # Pause button: toggles between holding back new jobs and continuing
+    def pause(self):
+        batch = self.active
+        if batch is None: return
+        if batch.state == 'paused':
+            batch.unpause()
+            self.pause_button.config(text='Pause')
+            self.stat.set('Continuing...')
+        elif batch.state == 'running':
+            batch.pause()
+            self.pause_button.config(text='Continue')
+            self.stat.set('Paused: running jobs finish, no new jobs start until Continue')
+
+    # Drain and Cancel buttons
+    def control(self, action):
+        batch = self.active
+        if batch is None: return
+        getattr(batch, action)()
+        self.pause_button.config(text='Pause')
+        if action == 'drain':
+            self.stat.set('Draining: waiting for the running jobs, no new jobs start')
+        else:
+            self.stat.set('Cancelling: stopping the running jobs and removing their partial outputs')
+
+    def batch_finished(self):
+        self.active = None
+        self.estimate_model = None      # the batch added job times to the journal
+        self.ui.post('pause', self.pause_button.config, {'text': 'Pause'})
+
+    # adds the selected (or all) datasets to the shared work queue for workers on other machines
+    def submit(self):
+        path = self.config.queue_dir or tk.filedialog.askdirectory(title='Shared queue directory')
+        if path == '' or path == (): return
+        self.config.queue_dir = path
+        from infobar_queue import work_queue
+        queue = work_queue(path)
+        records = self.result_tree.queue()
+        builder = executor(records, self.config, self.overwrite.get(), None)
+        # workers claim the oldest pending job first, so the longest jobs are submitted first
+        records = sorted(records, key=lambda r: builder.model.seconds(r.job_cost()), reverse=True)
+        added = sum(queue.submit(builder.job_args(r.inpath, r.outpath), r, appFuncs.job_memory(r.job_cost())) for r in records)
+        self.stat.set('Submitted %d jobs to %s   |   %d already queued', added, path, len(records) - added)
+
+    # writes QC measures of every processed run in the database to a CSV or Parquet file, in the background
+    def export_qc(self):
+        root = self.file_path or tk.filedialog.askdirectory(title='Database to export')
+        if root == '' or root == (): return
+        path = tk.filedialog.asksaveasfilename(title='Export QC table', defaultextension='.csv',
+                                               filetypes=[('CSV', '*.csv'), ('Parquet', '*.parquet')])
+        if path == '' or path == (): return
+        progress = lambda count: self.stat.set('QC export: %d runs written', count)
+        from infobar_export import qc_export
+        def run():
+            try:
+                count = qc_export(root, self.dataset.get(), path, self.config, workers=self.config.scan_workers,
+                                  progress=progress)
+            except (RuntimeError, OSError) as e:
+                self.stat.set('QC export failed: %s', e)
+                return
+            self.stat.set('QC export: %d runs written to %s', count, path)
+        self.stat.set('QC export: reading %s', root)
+        self.processThreader(run)
+
+    # checks the output folders of the selected (or all listed) datasets in the background; broken ones are marked
+    # in the list and queued, so Resume reprocesses them
+    def verify_outputs(self):
+        records = self.result_tree.queue()
+        progress = lambda count: self.stat.set('Verifying: %d outputs checked', count)
+        from infobar_verify import verify_outputs, requeue
+        def run():
+            t1 = time.perf_counter()
+            checked, broken = verify_outputs(records, self.config, workers=self.config.scan_workers, progress=progress,
+                                             active=self.active)
+            requeue(broken, self.config)
+            self.ui.post(None, self.result_tree.update_rows, checked)
+            self.stat.set('Verified %d outputs in %.0f s   |   %d broken, queued for Resume', len(checked),
+                          time.perf_counter() - t1, len(broken))
+        self.stat.set('Verifying %d datasets...', len(records))
+        self.processThreader(run)
+
+    def processThreader(self, target):
         self.update_idletasks()
-        x = threading.Thread(target=self.process)
+        x = threading.Thread(target=target)
         x.daemon = True
         x.start()
 
 
 #   class for tkinter Treeview and related functions
 class result_window:
+    # Virtualized view: records stay in memory (fileList) and only the rows that fit in the window are materialized
+    # as Treeview items, re-filled whenever the view scrolls. Treeview item ids are the records' iid (their index in
+    # fileList); the selection is kept as a set of those ids so it survives scrolling.
 
-    def __init__(self, parent,viewer,stat):
+    def __init__(self, parent,viewer,stat,ui):
         # Draw a treeview of a fixed type
         self.viewer=viewer
         self.stat=stat
+        self.ui=ui
         self.parent=parent
         self.fileList=[]
-        self.tree = ttk.Treeview(self.parent, show='headings', columns=['Number', 'Name', 'Motion','Status'])
-        self.tree.grid(sticky='NSEW')
-        self.tree.heading("Number", text="#")
-        self.tree.heading("Name", text="Name")
-        self.tree.heading("Motion", text="Motion Stats")
-        self.tree.heading("Status", text="Status")
+        self.view=[]            # records in display order
+        self.top=0              # position in view of the first visible row
+        self.rows=1             # number of rows that fit in the window
+        self.tree = ttk.Treeview(self.parent, show='headings', columns=['Number', 'Name', 'Motion', 'FD', 'MaxFD', 'FDpct', 'Status', 'Wall', 'CPU', 'RSS'], selectmode='extended')
+        self.tree.grid(row=0, column=0, sticky='NSEW')
+        self.scrollbar = ttk.Scrollbar(self.parent, orient='vertical', command=self.yview)
+        self.scrollbar.grid(row=0, column=1, sticky='NS')
+        self.headings = {"Number": "#", "Name": "Name", "Motion": "Motion Stats", "FD": "Mean FD", "MaxFD": "Max FD",
+                         "FDpct": "% FD > thr", "Status": "Status", "Wall": "Wall (min)", "CPU": "CPU (min)",
+                         "RSS": "Peak RSS (GB)"}
+        for column, text in self.headings.items():
+            self.tree.heading(column, text=text, command=lambda c=column: self.sort_by(c))
+        self.sort_keys = {"Number": lambda r: r.iid, "Name": lambda r: str(r.inpath),
+                          "Motion": lambda r: (float(r.motion[0]), float(r.motion[1])),
+                          "FD": lambda r: r.fd[0] if r.fd else -1, "MaxFD": lambda r: r.fd[1] if r.fd else -1,
+                          "FDpct": lambda r: r.fd[2] if r.fd else -1, "Status": self.status_text,
+                          "Wall": lambda r: r.usage['wall_s'] if r.usage else -1,
+                          "CPU": lambda r: r.usage.get('user_s', 0) + r.usage.get('sys_s', 0) if r.usage else -1,
+                          "RSS": lambda r: r.usage.get('maxrss_mb', 0) if r.usage else -1}
+        self.sort_column = None
+        self.sort_reverse = False
+        self.query = None
+        self.on_summary = None  # called with the rows Process would run whenever they change
 
         self.tree.column("Number", width=30, stretch=tk.NO, anchor='e')
         self.tree.column("Name", width=400)
         self.tree.column("Motion", width=150, stretch=tk.NO, anchor='center')
+        for column in ("FD", "MaxFD", "FDpct", "Wall", "CPU", "RSS"):
+            self.tree.column(column, width=80, stretch=tk.NO, anchor='center')
+        self.tree.tag_configure('outlier', foreground='red')
         self.tree.column("Status", width=100, stretch=tk.NO, anchor='center')
 
         self.tree.bind('<Button-1>',self.left_click)
@@ -457,254 +815,352 @@ class result_window:
         self.tree.bind(('<Button-3>' ), self.double_left_click)
         self.tree.bind(('<Button-2>'), self.double_left_click)
         self.tree.bind(('w'), self.double_left_click)
+        self.tree.bind('<<TreeviewSelect>>', self.selection_changed)
+        self.tree.bind('<Configure>', self.resize)
+        self.tree.bind('<MouseWheel>', lambda e: self.scroll_rows(-1 if e.delta > 0 else 1, 'units'))
+        self.tree.bind('<Button-4>', lambda e: self.scroll_rows(-1, 'units'))
+        self.tree.bind('<Button-5>', lambda e: self.scroll_rows(1, 'units'))
+        self.tree.bind('<Up>', lambda e: self.step(-1))
+        self.tree.bind('<Down>', lambda e: self.step(1))
+        self.tree.bind('<Prior>', lambda e: self.scroll_rows(-1, 'pages'))
+        self.tree.bind('<Next>', lambda e: self.scroll_rows(1, 'pages'))
+        self.selected_ids = set()
+        self.selected = ()
+        self.clickID = ''
         self.last_focus=None
 
 
     def display(self):
+        for iid, row in enumerate(self.fileList):
+            row.iid = iid
+        self.selected_ids = set()
+        self.selected = ()
+        self.apply_view()
+
+    # filter query typed in the Filters field; an invalid query leaves the view unchanged
+    def set_query(self, text):
+        try:
+            self.query = record_query(text) if text.strip() else None
+        except ValueError as e:
+            self.stat.set('Filter: %s', e)
+            return
+        self.apply_view()
+
+    # rebuilds the view from the scanned records with the current filter and sort order
+    def apply_view(self):
+        self.view = self.query.filter(self.fileList) if self.query else list(self.fileList)
+        # rows hidden by the filter leave the selection
+        if self.selected_ids:
+            self.selected_ids &= {row.iid for row in self.view}
+            self.selected = tuple(sorted(self.selected_ids))
+        if self.sort_column is not None:
+            self.view.sort(key=self.sort_keys[self.sort_column], reverse=self.sort_reverse)
+        self.top = 0
+        self.refresh()
+        self.summary()
+
+    def set_fd_threshold(self, threshold):
+        self.headings['FDpct'] = '%% FD > %g' % threshold
+        self.draw_headings()
+
+    def draw_headings(self):
+        for c, text in self.headings.items():
+            if c == self.sort_column: text += ' \u25bc' if self.sort_reverse else ' \u25b2'
+            self.tree.heading(c, text=text)
+
+    # sorts on a column heading; clicking the same heading again reverses the order
+    def sort_by(self, column):
+        self.sort_reverse = column == self.sort_column and not self.sort_reverse
+        self.sort_column = column
+        self.draw_headings()
+        self.view.sort(key=self.sort_keys[column], reverse=self.sort_reverse)
+        self.refresh()
+
+    # motion summary of the selected rows, or of all rows in the view when nothing is selected
+    def summary(self):
+        if self.on_summary is not None: self.on_summary(self.queue())
+        if self.selected_ids:
+            self.motion_summary([self.fileList[i] for i in self.selected], 'Selected: %d of %d' % (len(self.selected_ids), len(self.view)))
+        else:
+            self.motion_summary(self.view, 'Matches Found: %d' % len(self.view))
+
+    # mean +/- sample standard deviation of absolute and relative motion over records
+    def motion_summary(self, records, label):
+        self.absolute = self.mean_std([float(r.motion[0]) for r in records])
+        self.relative = self.mean_std([float(r.motion[1]) for r in records])
+        self.outliers = sum(1 for r in records if r.outlier)
+        self.set_motion_stat(label)
+
+    @staticmethod
+    def mean_std(values):
+        n = len(values)
+        if n == 0: return [0, 0]
+        mean = sum(values) / n
+        if n == 1: return [mean, 0]
+        return [mean, (sum((v - mean) ** 2 for v in values) / (n - 1)) ** 0.5]
+
+    # re-materializes the visible window of the view
+    def refresh(self):
+        self.top = max(0, min(self.top, len(self.view) - self.rows))
         self.delete()
-        index = iid = 0
-        self.abs=[]
-        self.rel=[]
-        for row in self.fileList:
-            inPath = row[0]
-            motion = row[2]
-            pvp = row[3]
-            pop = row[4]
-
-            p1 = inPath.relative_to(self.file_path)
-            disp = '  >>  '.join(p1.parts)
-            self.tree.insert("", index, iid, values=(iid + 1, disp))
-            self.motion_stats(iid, motion)
-
-            if pvp == 0:
-                self.processing_status(iid, 'Not Processed')
-            elif pop==0:
-                self.processing_status(iid, 'Processed')
-            else:
-                self.processing_status(iid, 'Post-Processed')
-            index = iid = index + 1
-
-            self.abs.append(float(motion[0]))
-            self.rel.append(float(motion[1]))
-
-        if len(self.abs)>1:
-            self.absolute = [statistics.mean(self.abs), statistics.stdev(self.abs)]
-            self.relative = [statistics.mean(self.rel), statistics.stdev(self.rel)]
+        window = self.view[self.top:self.top + self.rows + 1]
+        for position, row in enumerate(window, self.top):
+            self.tree.insert("", 'end', row.iid, values=(position + 1, self.display_name(row), self.motion_text(row.motion))
+                             + self.fd_text(row) + (self.status_text(row),) + self.usage_text(row),
+                             tags=('outlier',) if row.outlier else ())
+        visible = [str(row.iid) for row in window if row.iid in self.selected_ids]
+        self.tree.selection_set(visible)
+        n = max(len(self.view), 1)
+        self.scrollbar.set(self.top / n, min(1, (self.top + self.rows) / n))
+
+    def display_name(self, row):
+        try:
+            p1 = row.inpath.relative_to(self.file_path)
+        except ValueError:
+            p1 = row.inpath
+        return '  >>  '.join(p1.parts)
+
+    @staticmethod
+    def status_text(row):
+        return row.message or row.status()
+
+    def resize(self, event):
+        rowheight = int(ttk.Style().lookup('Treeview', 'rowheight') or 20)
+        rows = max(1, (event.height - rowheight) // rowheight)
+        if rows != self.rows:
+            self.rows = rows
+            self.refresh()
+
+    # scrollbar callback
+    def yview(self, *args):
+        if args[0] == 'moveto':
+            self.top = int(float(args[1]) * len(self.view))
+            self.refresh()
+        elif args[0] == 'scroll':
+            self.scroll_rows(int(args[1]), args[2])
+
+    def scroll_rows(self, n, what):
+        self.top += n * (self.rows if what == 'pages' else 3 if what == 'units' else 1)
+        self.refresh()
+        return 'break'
+
+    # arrow keys: move the focus, scrolling when it leaves the window
+    def step(self, n):
+        items = self.tree.get_children()
+        if not items: return 'break'
+        focus = self.tree.focus()
+        position = items.index(focus) if focus in items else 0
+        if 0 <= position + n < min(len(items), self.rows):
+            target = items[position + n]
         else:
-            try:
-                self.absolute = [statistics.mean(self.abs), 0]
-                self.relative = [statistics.mean(self.rel), 0]
-            except:
-                self.absolute = [0, 0]
-                self.relative = [0, 0]
-        self.set_motion_stat()
+            self.top += n
+            self.refresh()
+            items = self.tree.get_children()
+            target = items[min(max(position, 0), len(items) - 1)] if items else ''
+        if target:
+            self.tree.focus(target)
+            self.tree.selection_set(target)
+        return 'break'
 
     # generate queue for processing
     def queue(self):
-        fl = self.fileList
-        # id = list(range(0, len(fl)))
-        index = self.tree.selection()
+        fl = self.view
+        index = self.selected
         # if any items are selected, modify the file list to be processed
         if len(index) != 0:
             N = [int(i) for i in index]
-            fl = [fl[j] for j in N]
-            # id = N
+            fl = [self.fileList[j] for j in N]
         return fl
+
+    # selection of the visible rows merged into the selection set, which processing threads read as a plain tuple
+    def selection_changed(self, event=None):
+        visible = {int(i) for i in self.tree.get_children()}
+        chosen = {int(i) for i in self.tree.selection()}
+        self.selected_ids = (self.selected_ids - visible) | chosen
+        self.selected = tuple(sorted(self.selected_ids))
+        self.summary()
+
     # clears selection of all items in treeview
     def clear(self):
+        self.selected_ids = set()
+        self.selected = ()
         for item in self.tree.selection(): self.tree.selection_remove(item)
-        self.viewer.clearFrame()
+        self.viewer.clear()
+        self.summary()
 
     def delete(self):
         self.tree.delete(*self.tree.get_children())
 
+    # redraws the visible rows of datasets that changed on disk and the motion summary
+    def update_rows(self, records):
+        for row in records:
+            # messages of jobs in progress or that did not finish stay: the output folder on disk says nothing about
+            # them; the others are replaced by the status read from disk
+            if not (row.message or '').startswith(('Queued', 'Processing', 'Failed', 'Cancelled')): row.message = None
+            if row.iid is None or not self.tree.exists(row.iid): continue
+            values = (self.motion_text(row.motion),) + self.fd_text(row) + (self.status_text(row),)
+            for column, text in zip(('Motion', 'FD', 'MaxFD', 'FDpct', 'Status'), values):
+                self.tree.set(row.iid, column, text)
+        self.summary()
+
     # display status of a treeview item
-    def processing_status(self, iid, stsMsg):
-        self.tree.set(iid, 'Status', stsMsg)
-        self.parent.update_idletasks()
+    # safe to call from worker threads: updates are applied by the Tk thread, latest message per item
+    def processing_status(self, record, stsMsg):
+        self.ui.post(('status', id(record)), self.set_status, record, stsMsg)
+
+    def set_status(self, record, stsMsg):
+        record.message = stsMsg
+        if record.iid is not None and self.tree.exists(record.iid):
+            self.tree.set(record.iid, 'Status', stsMsg)
+            for column, text in zip(('Wall', 'CPU', 'RSS'), self.usage_text(record)):
+                self.tree.set(record.iid, column, text)
+
+    def set_motion_stat(self, label):
+        self.stat.set('%s   |    Absolute Motion = %.2f +/- %.2f mm   |    Relative Motion = %.2f  +/- %.2f mm   |    FD Outliers: %d',
+                      label, self.absolute[0], self.absolute[1], self.relative[0],
+                      self.relative[1], self.outliers)
+
+    @staticmethod
+    def motion_text(motion):
+        return 'Abs:' + str(motion[0]) + ' Rel: ' + str(motion[1])
+
+    # wall and CPU minutes and peak memory of the last job
+    @staticmethod
+    def usage_text(row):
+        usage = row.usage
+        if not usage or 'user_s' not in usage: return ('-', '-', '-')
+        return ('%.1f' % (usage['wall_s'] / 60), '%.1f' % ((usage['user_s'] + usage['sys_s']) / 60),
+                '%.2f' % (usage['maxrss_mb'] / 1024))
+
+    # mean FD (starred for group outliers), max FD and percentage of volumes above the threshold
+    @staticmethod
+    def fd_text(row):
+        if row.fd is None: return ('-', '-', '-')
+        return ('%.2f%s' % (row.fd[0], ' *' if row.outlier else ''), '%.2f' % row.fd[1], '%.1f' % row.fd[2])
+
+    mc_images = ['trans.png', 'rot.png', 'disp.png']
 
-    def set_motion_stat(self):
-        self.stat.set('Matches Found: %d   |    Absolute Motion = %.2f +/- %.2f mm   |    Relative Motion = %.2f  +/- %.2f mm',
-                      len(self.fileList), self.absolute[0], self.absolute[1], self.relative[0],
-                      self.relative[1])
+    def mc_paths(self, record):
+        return [record.inpath / 'mc' / name for name in self.mc_images]
 
-    def motion_stats(self, iid, motion):
-        MotionStats = 'Abs:' + str(motion[0]) + ' Rel: ' + str(motion[1])
-        self.tree.set(iid, 'Motion', MotionStats)
+    def IC_paths(self, record):
+        return [record.outpath / 'melodic.ica' / 'report' / f'IC_{IC}_thresh.png' for IC in record.motion_components()]
 
     def left_click(self, event):
         iid = self.tree.identify_row(event.y)
         self.clickID =iid
         if not iid == '':
-            iid=int(iid)
-            path = self.fileList[iid][0] / 'mc'
-            name = ['trans.png', 'rot.png', 'disp.png']
-            im_list=[]
-            for i in name:
-                im_list.append(path/i)
-            self.viewer.display(im_list,mode=1)
+            record = self.fileList[int(iid)]
+            self.viewer.display(self.mc_paths(record),mode=1)
+            # neighbouring rows are the next ones to be looked at, and this row's components after a right click
+            pos = self.top + self.tree.index(iid)
+            for near in self.view[max(pos - 1, 0):pos + 2]:
+                if near is not record: self.viewer.cache.prefetch(self.mc_paths(near))
+            if record.pvp == 1:
+                self.viewer.cache.submit(lambda: self.viewer.cache.prefetch(self.IC_paths(record)[:2]))
 
     def double_left_click(self, event):
         iid = self.clickID
         if iid != '':
             self.clickID = ''
-            iid = int(iid)
-            outpath = self.fileList[iid][1]
-            path = appFuncs.generateProcessedOutpath(outpath)
-            pvp = self.fileList[iid][3]
-            pop=self.fileList[iid][4]
-            if pvp == 1:
-                motion_IC_file = outpath / 'classified_motion_ICs.txt'
-                h = open(motion_IC_file,'r')
-                content =h.readlines()
-                for line in content:
-                    motion_IC = line.split(',')
-                    motion_IC = list(map(int,motion_IC))
-                im_list= []
-                for IC in motion_IC:
-                    im_list.append(outpath/'melodic.ica'/'report'/f'IC_{IC}_thresh.png')
-                    mode = 2
-
-            if pop == 1 and pvp == 1:
-                im_list_post = [path / 'rendered_thresh_zstat1.png', path / 'tsplot' / 'tsplot_zstat1.png']
-                im_list += im_list_post
-                mode = 3
-            if pvp == 1:
+            record = self.fileList[int(iid)]
+            if record.pvp == 1:
+                im_list = self.IC_paths(record)
+                mode = 2
+                if record.pop == 1:
+                    path = record.postpath
+                    im_list += [path / 'rendered_thresh_zstat1.png', path / 'tsplot' / 'tsplot_zstat1.png']
+                    mode = 3
                 self.viewer.display(im_list, mode)
 
 
+    # removes one dataset from the list; later records move up one index
     def delete_entry(self, event):
         iid = self.clickID
         if not iid=='':
             iid=int(iid)
-            del self.fileList[iid]
-            self.delete()
-            self.display()
+            record = self.fileList.pop(iid)
+            record.iid = None
+            for row in self.fileList[iid:]:
+                row.iid -= 1
+            if record in self.view: self.view.remove(record)
+            self.selected_ids = {i - (i > iid) for i in self.selected_ids if i != iid}
+            self.selected = tuple(sorted(self.selected_ids))
+            self.refresh()
+            self.summary()
             self.clickID = ''
 
-#   helper class for common use functions
-class appFuncs:
-
-    # Generates file dialog box
-    @staticmethod
-    def selectPath(file_path):
-        f = tk.filedialog.askdirectory()
-        if f!='':
-            file_path=f
-        return file_path
-
-    # generates output folder path
-    @staticmethod
-    def generateOutpath(inPath, prefix, suffix):
-        z=inPath.stem.replace(prefix,'');  z=z+suffix
-        outPath = (Path(inPath).parent) / z
-        return outPath
-
-    @staticmethod
-    def generateProcessedOutpath(path):
-        fo=Path(path).glob('*.feat')
-        processedOutpath=''
-        for i in fo:
-           processedOutpath=i
-        return processedOutpath
-
-    # Identify previously processed datasets
-    @staticmethod
-    def prevProcessed(outPath):
-        pvp = 0
-        if Path(outPath).is_dir(): pvp = 1
-        return pvp
-
-    @staticmethod
-    def postProcessed(path):
-        # idenitfy if the dataset has been processed through ICA and post-processed as well
-        pop = 0
-        # is feat file present?
-        # print(path)
-        fo=Path(path).glob('*.feat')
-        for i in fo:
-            if i.is_dir() == True:
-                pop = 1
-        return pop
-
-    @staticmethod
-    def postProcessed_identifier(path):
-        # if melodic.ica is a sibling directory, then this is assumed to be post-processed dataset generated from
-        # ICA-AROMA processed data
-        pop_i = 0
-        fo = Path(path).parent/'melodic.ica'
-        if fo.is_dir() == True: pop_i = 1
-        return pop_i
-
-    @staticmethod
-    def headMotion_stats(path):
-        motion = [0, 0]
-        if path.is_dir():
-            a=path/"report_prestats.html"
-            f = open(str(a), encoding="utf8")
-            soup = BeautifulSoup(f,'lxml')
-            f.close
-            try:
-                W=soup.find_all('p')[-4]
-                E=''.join(W.find('br').next_siblings)
-                S=E.split('mm')
-                motion=[S[0].split('=')[1],S[1].split('=')[1]]
-            except:
-                motion=[0,0]
-        return motion
-
-#  class for parallelization and execution
-class executor:
-    def __init__(self, list, icaPath, overwrite, status, user_options, result_tree):
-        self.fl = list
-        self.icaPath = icaPath
-        self.ov = overwrite
-        self.status = status
-        self.result_tree = result_tree
-        # self.aux_args=[]
-        self.aux_args=['-dim',user_options[1],'-den',user_options[2]]
-        if user_options[0]!='': self.aux_args.extend(['-tr',user_options[0]])
-        if self.ov == 1: self.aux_args.append("-overwrite")
-
-    def call_ICA(self, que):
-        args = que[0]
-        id = que[1]
-        # print(args)
-        self.status(id, 'Processing...')
-        subprocess.run(args)
-        self.status(id, 'Processed')
-        self.result_tree[id][3] = 1
-
-    def threader(self):
-        que=self.queue_prep()
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            executor.map(self.call_ICA, que)
-
-    def queue_prep(self):
-        que=[]
-        for row in self.fl:
-            args = ["python2.7", str(self.icaPath), "-feat", str(row[0]), "-out", str(row[1])] + self.aux_args
-            que.append([args, row[-1]])
-        return que
-
-
 #-----------------------------------------------------------------------------------------------------------------------
 
+# thread-safe channel from worker threads to the Tk thread
+# Updates posted from any thread are queued and applied by the Tk thread in one batch per frame; updates sharing a
+# key are coalesced so only the latest one is applied. Posts from the Tk thread itself are applied immediately.
+class ui_dispatcher:
+    def __init__(self, root, interval=40):
+        self.root = root
+        self.interval = interval
+        self.tk_thread = threading.get_ident()
+        self.queue = queue.Queue()
+        self.root.after(self.interval, self.drain)
+
+    def in_tk_thread(self):
+        return threading.get_ident() == self.tk_thread
+
+    def post(self, key, func, *args):
+        if self.in_tk_thread():
+            func(*args)
+        else:
+            self.queue.put((key, func, args))
+
+    # an update that raises is reported and skipped; the next drain is scheduled whatever happens, as without it no
+    # update from another thread would reach the window again
+    def drain(self):
+        batch = {}
+        try:
+            while True:
+                key, func, args = self.queue.get_nowait()
+                if key is None: key = object()
+                batch.pop(key, None)        # keep the order of the latest update
+                batch[key] = (func, args)
+        except queue.Empty:
+            pass
+        try:
+            for func, args in batch.values():
+                try:
+                    func(*args)
+                except tk.TclError:
+                    pass                        # widget went away
+                except Exception:
+                    import traceback
+                    traceback.print_exc()
+        finally:
+            self.root.after(self.interval, self.drain)
+
 class StatusBar(tk.Frame):
 
-    def __init__(self, master):
+    def __init__(self, master, ui):
         tk.Frame.__init__(self, master)
+        self.ui = ui
+        self.estimate = tk.Label(self, bd=1, relief='sunken', anchor='e')
+        self.estimate.pack(side='right')
         self.label = tk.Label(self, bd=1, relief='sunken', anchor='w')
         self.label.pack(fill=tk.X)
 
     def set(self, format, *args):
-        self.label.config(text=format % args)
-        self.label.update_idletasks()
+        if self.ui.in_tk_thread():
+            self.label.config(text=format % args)
+            self.label.update_idletasks()
+        else:
+            self.ui.post('statusbar', self.label.config, {'text': format % args})
 
     def clear(self):
         self.label.config(text="")
         self.label.update_idletasks()
 
+    # expected duration of processing, on the right of the status bar
+    def set_estimate(self, format, *args):
+        self.ui.post('estimate', self.estimate.config, {'text': format % args if args else format})
+
 #-----------------------------------------------------------------------------------------------------------------------
 
 class MainApp(tk.Frame):
@@ -715,21 +1171,30 @@ class MainApp(tk.Frame):
         parent.columnconfigure(0, weight=1)
         parent.rowconfigure(0, weight=1)
 
-        # draw a viewer window
-        viewer_root=tk.Toplevel()
+        parent.protocol("WM_DELETE_WINDOW", self.close)
+
         self.config=config()
-        # Components
-        self.viewer = Viewer(viewer_root)
+        self.ui = ui_dispatcher(parent)
+        # Components; the viewer window opens with the first image shown
+        self.viewer = Viewer(self.ui)
         self.menubar = Menubar(parent,self.config)
-        self.statusbar = StatusBar(parent)
-        self.mainarea = MainArea(parent, self.statusbar, self.viewer, self.config, borderwidth=1, relief=tk.RAISED)
+        self.statusbar = StatusBar(parent, self.ui)
+        self.mainarea = MainArea(parent, self.statusbar, self.viewer, self.config, self.ui, borderwidth=1, relief=tk.RAISED)
+        self.menubar.export = self.mainarea.export_qc
+        self.menubar.verify = self.mainarea.verify_outputs
 
         # configurations
         self.mainarea.grid(column=0, row=0, sticky='WENS')
         self.statusbar.grid(column=0, row=1, sticky='WE')
         self.statusbar.set('Ready')
 
+    # closing the window cancels a running batch, so its jobs do not keep running without INFOBAR
+    def close(self):
+        if self.mainarea.active is not None: self.mainarea.active.cancel()
+        self.master.destroy()
+
 #-----------------------------------------------------------------------------------------------------------------------
-root = tk.Tk()
-PR = MainApp(root)
-root.mainloop()
+if __name__ == '__main__':
+    root = tk.Tk()
+    PR = MainApp(root)
+    root.mainloop()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# INFOBAR Interface for batch processing ICA-AROMA
+# Benchmarks: stands in for ICA_AROMA.py, taking the same arguments and writing the files INFOBAR reads
+# Copyright (C) 2020  Manish Anand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Environment:
+#   INFOBAR_STUB_SECONDS   time MELODIC takes in each job, skipped when a decomposition is given with -md (default 0)
+#   INFOBAR_STUB_FAIL      probability that a job exits with status 1 (default 0)
+
+import argparse, gzip, os, random, shutil, struct, sys, time
+from pathlib import Path
+from make_database import nifti_header
+
+# spatial and time dimensions from a NIfTI-1 header
+def feat_dims(path):
+    with gzip.open(path) as f:
+        hdr = f.read(56)
+    dim = struct.unpack('<8h', hdr[40:56])
+    return list(dim[1:dim[0] + 1])
+
+def main(argv=None):
+    p = argparse.ArgumentParser()
+    p.add_argument('-feat', required=True)
+    p.add_argument('-out', required=True)
+    p.add_argument('-dim', default='0')
+    p.add_argument('-den', default='nonaggr')
+    p.add_argument('-tr')
+    p.add_argument('-md')
+    p.add_argument('-overwrite', action='store_true')
+    args = p.parse_args(argv)
+    out = Path(args.out)
+    # ICA-AROMA stops when the output folder exists, unless told to overwrite it, and exits with status 0
+    if out.is_dir():
+        if not args.overwrite:
+            print('Output directory', out, 'already exists. Use -overwrite to overwrite it.')
+            return 0
+        shutil.rmtree(out)
+    if not Path(args.feat, 'filtered_func_data.nii.gz').exists():
+        print('Input file not found')
+        return 1
+    melodic = out / 'melodic.ica'
+    files = ('melodic_IC.nii.gz', 'melodic_mix', 'melodic_FTmix')
+    ICs = [1, 3, 5]
+    if args.md and all((Path(args.md) / name).is_file() for name in files):
+        # like ICA-AROMA: link to a given decomposition, or to its files when it has no thresholded maps (stats/)
+        print('  - The existing/specified MELODIC directory will be used.')
+        md = Path(args.md).resolve()
+        out.mkdir(parents=True)
+        if (md / 'stats').is_dir():
+            os.symlink(md, melodic)
+        else:
+            melodic.mkdir()
+            for name in files:
+                os.symlink(md / name, melodic / name)
+    else:
+        print('Step 1) MELODIC')
+        time.sleep(float(os.environ.get('INFOBAR_STUB_SECONDS', 0)))
+        (melodic / 'report').mkdir(parents=True)
+        (melodic / 'stats').mkdir()
+        # header only: 40 components of the input's volume
+        dims = feat_dims(Path(args.feat) / 'filtered_func_data.nii.gz')
+        (melodic / 'melodic_IC.nii.gz').write_bytes(nifti_header(dims[:3] + [40]))
+        for name in files[1:]:
+            (melodic / name).write_text('0\n' * 40)
+        for IC in ICs:
+            shutil.copyfile(Path(args.feat) / 'mc' / 'rot.png', melodic / 'report' / f'IC_{IC}_thresh.png')
+    if random.random() < float(os.environ.get('INFOBAR_STUB_FAIL', 0)):
+        print('Classification failed')
+        return 1
+    (out / 'classified_motion_ICs.txt').write_text(','.join(map(str, ICs)))
+    dens = ['nonaggr', 'aggr'] if args.den == 'both' else [args.den]
+    for den in dens:
+        if den != 'no':
+            shutil.copyfile(Path(args.feat) / 'filtered_func_data.nii.gz', out / f'denoised_func_data_{den}.nii.gz')
+    print('Finished')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
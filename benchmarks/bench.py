@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# INFOBAR Interface for batch processing ICA-AROMA
+# Benchmarks: times searching, listing and processing synthetic databases of several sizes
+# Copyright (C) 2020  Manish Anand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Every stage reports wall time and the peak of memory allocated by Python while it ran (tracemalloc, which slows
+# Python code down; --no-memory gives plain timings). Stages:
+#   search cold       search() with an empty dataset index: scan, verification and motion of every run
+#   search warm       search() again, answered from the index
+#   verify_dataset    the report_prestats.html check on every run folder
+#   aggregated_list   output folders, head motion and FD of every run, without the index
+#   display           result_window.display() of all runs (skipped without a display)
+#   verify_outputs    the fast check of every output folder (the synthetic images are headers only, so all fail it)
+#   executor          jobs/s through executor.threader() with the ICA-AROMA stub taking no time
+
+import argparse, json, os, shutil, sys, tempfile, time, tracemalloc
+from pathlib import Path
+
+here = Path(__file__).resolve().parent
+sys.path.insert(0, str(here.parent))
+sys.path.insert(0, str(here))
+
+from infobar_core import config, search, verify_dataset, aggregated_list, dataset_index, executor
+from make_database import make_database
+from infobar_verify import verify_outputs
+
+# runs func once; returns its result, seconds taken and peak MB allocated
+def measure(func, *args, memory=True):
+    if memory:
+        tracemalloc.start()
+    t1 = time.perf_counter()
+    try:
+        result = func(*args)
+        seconds = time.perf_counter() - t1
+    finally:
+        peak = tracemalloc.get_traced_memory()[1] / 2**20 if memory else None
+        if memory: tracemalloc.stop()
+    return result, seconds, peak
+
+# settings.json for a benchmark: the stub instead of ICA-AROMA, run by this interpreter
+def bench_config(work):
+    with open(here.parent / 'settings.json') as f:
+        settings = json.load(f)
+    settings.update(icaPath=str(here / 'ICA_AROMA_stub.py'), python=sys.executable, max_retries=0)
+    path = work / 'settings.json'
+    with open(path, 'w') as f:
+        json.dump(settings, f)
+    return config(path)
+
+# result_window on a hidden Tk root, or None without a display
+def result_view():
+    try:
+        import tkinter as tk
+        import INFOBAR
+        root = tk.Tk()
+    except Exception:
+        return None, None
+    root.withdraw()
+    frame = tk.Frame(root)
+    class status:
+        def set(self, *args): pass
+    return root, INFOBAR.result_window(frame, None, status(), INFOBAR.ui_dispatcher(root))
+
+def bench_size(work, subjects, tasks, jobs, memory):
+    root = work / f'db_{subjects}'
+    conf = bench_config(work)
+    make_database(root, subjects, tasks)
+    results = []
+    def add(stage, items, seconds, peak):
+        results.append(dict(subjects=subjects, stage=stage, items=items, seconds=round(seconds, 3),
+                            per_second=round(items / seconds, 1) if seconds else None,
+                            peak_mb=None if peak is None else round(peak, 1)))
+
+    if os.path.exists(conf.index_path): os.remove(conf.index_path)
+    records, seconds, peak = measure(search, root, '', '', conf, memory=memory)
+    add('search cold', len(records), seconds, peak)
+    records, seconds, peak = measure(search, root, '', '', conf, memory=memory)
+    add('search warm', len(records), seconds, peak)
+
+    feats = sorted(root.glob('*/*/*.feat'))
+    _, seconds, peak = measure(verify_dataset, feats, memory=memory)
+    add('verify_dataset', len(feats), seconds, peak)
+
+    index = dataset_index(work / 'empty_index.sqlite')
+    _, seconds, peak = measure(aggregated_list, records, index, conf.fd_threshold, conf.scan_workers, memory=memory)
+    add('aggregated_list', len(records), seconds, peak)
+
+    (checked, broken), seconds, peak = measure(verify_outputs, records, conf, False, conf.scan_workers, memory=memory)
+    add('verify_outputs', len(checked), seconds, peak)
+
+    tk_root, view = result_view()
+    if view is not None:
+        view.fileList = records
+        def display():
+            view.display()
+            tk_root.update()
+        _, seconds, peak = measure(display, memory=memory)
+        add('display', len(records), seconds, peak)
+        tk_root.destroy()
+
+    if jobs:
+        queue = records[:jobs]
+        (work / 'out').mkdir(exist_ok=True)
+        for record in queue:
+            record.outpath = work / 'out' / f'{subjects}_{record.iid}_AROMA_Output'
+        process = executor(queue, conf, 1, None)
+        _, seconds, peak = measure(process.threader, memory=memory)
+        add('executor', len(queue), seconds, peak)
+    shutil.rmtree(root)
+    shutil.rmtree(work / 'out', ignore_errors=True)
+    return results
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description='time INFOBAR on synthetic databases of several sizes')
+    p.add_argument('--subjects', default='100,1000,5000', help='comma separated database sizes in subjects')
+    p.add_argument('--tasks', default='rest,motor', help='comma separated task names (runs per subject)')
+    p.add_argument('--jobs', type=int, default=100, help='jobs run through the executor at each size (0 to skip)')
+    p.add_argument('--no-memory', action='store_true', help='do not trace memory, for timings without its overhead')
+    p.add_argument('--json', help='also write the results to this file as JSON')
+    p.add_argument('--workdir', help='directory for the databases (default: a temporary one)')
+    args = p.parse_args(argv)
+
+    work = Path(args.workdir or tempfile.mkdtemp(prefix='infobar_bench_'))
+    work.mkdir(parents=True, exist_ok=True)
+    results = []
+    print(f'{"subjects":>8} {"stage":<16} {"items":>7} {"seconds":>9} {"items/s":>10} {"peak MB":>8}')
+    try:
+        for subjects in map(int, args.subjects.split(',')):
+            for row in bench_size(work, subjects, args.tasks.split(','), args.jobs, not args.no_memory):
+                results.append(row)
+                print(f'{row["subjects"]:>8} {row["stage"]:<16} {row["items"]:>7} {row["seconds"]:>9.3f} '
+                      f'{row["per_second"] or 0:>10.1f} {row["peak_mb"] if row["peak_mb"] is not None else "-":>8}', flush=True)
+    finally:
+        if not args.workdir: shutil.rmtree(work, ignore_errors=True)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# INFOBAR Interface for batch processing ICA-AROMA
+# Benchmarks: builds a synthetic database of FEAT preprocessed runs laid out the way INFOBAR expects
+# Copyright (C) 2020  Manish Anand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+#   <root>/sub0000/ses1/<task>_pre_AROMA.feat        report_prestats.html, mc/ (.rms, .par, plots), filtered_func_data header
+#   <root>/sub0000/ses1/<task>_AROMA_Output          for a share of the runs: classified_motion_ICs.txt, melodic.ica
+#   <root>/sub0000/ses1/<task>_AROMA_Output/*.feat   for a share of those: post-stats FEAT with its plots
+# A few runs have no report_prestats.html (invalid) or a post-stats report (not preprocessed) to exercise the checks.
+
+import argparse, gzip, os, random, struct, sys, base64
+from pathlib import Path
+
+# smallest valid PNG (1x1 grey pixel), enough for the viewer to decode
+PNG = base64.b64decode('iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAAAAAA6fptVAAAACklEQVR4nGNoAAAAggCBd81ytgAAAABJRU5ErkJggg==')
+
+REPORT = ('<html><head><title>FEAT Report</title></head><body><hr><b>Pre-stats</b><br>\n'
+          '<p>Motion correction using MCFLIRT<br>\n'
+          '<p>MCFLIRT estimated mean displacements: absolute={abs}mm, relative={rel}mm<br>\n'
+          '<IMG BORDER=0 SRC="mc/rot.png"><IMG BORDER=0 SRC="mc/trans.png"><IMG BORDER=0 SRC="mc/disp.png">\n'
+          '</body></html>\n')
+
+# header-only NIfTI-1 (.nii.gz) with the given dimensions, as written for float32 data
+def nifti_header(dims):
+    hdr = bytearray(352)
+    struct.pack_into('<i', hdr, 0, 348)
+    struct.pack_into('<8h', hdr, 40, len(dims), *(list(dims) + [1] * (7 - len(dims))))
+    struct.pack_into('<hh', hdr, 70, 16, 32)                # datatype FLOAT32, bitpix
+    struct.pack_into('<8f', hdr, 76, 1, 3, 3, 3, 2, 0, 0, 0)  # pixdim, TR 2 s
+    struct.pack_into('<f', hdr, 108, 352.0)                 # vox_offset
+    hdr[344:348] = b'n+1\0'
+    return gzip.compress(bytes(hdr))
+
+def write(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'wb' if isinstance(data, bytes) else 'w') as f:
+        f.write(data)
+
+# one preprocessed run with realistic motion parameters; returns its mean absolute/relative displacement
+def make_run(feat, rng, volumes, spiky):
+    mc = feat / 'mc'
+    steps = [[rng.gauss(0, 0.0008) for _ in range(3)] + [rng.gauss(0, 0.03) for _ in range(3)] for _ in range(volumes)]
+    if spiky:
+        for v in rng.sample(range(volumes), max(1, volumes // 20)):
+            steps[v] = [x * 20 for x in steps[v]]
+    params, position = [], [0.0] * 6
+    for step in steps:
+        position = [p + s for p, s in zip(position, step)]
+        params.append(position)
+    write(mc / 'prefiltered_func_data_mcf.par', ''.join('  '.join('%.6f' % x for x in row) + '  \n' for row in params))
+    rel = sum(sum(abs(x) for x in step[3:]) for step in steps[1:]) / max(volumes - 1, 1)
+    absolute = sum(sum(abs(x) for x in row[3:]) for row in params) / volumes
+    write(mc / 'prefiltered_func_data_mcf_abs_mean.rms', '%.6f\n' % absolute)
+    write(mc / 'prefiltered_func_data_mcf_rel_mean.rms', '%.6f\n' % rel)
+    for name in ('rot.png', 'trans.png', 'disp.png'):
+        write(mc / name, PNG)
+    write(feat / 'report_prestats.html', REPORT.format(abs=int(absolute * 100) / 100.0, rel=int(rel * 100) / 100.0))
+    write(feat / 'filtered_func_data.nii.gz', nifti_header([64, 64, 36, volumes]))
+
+# ICA-AROMA output of a run, optionally with a post-stats FEAT analysis of the denoised data
+def make_output(out, rng, post):
+    ICs = sorted(rng.sample(range(1, 41), rng.randint(3, 15)))
+    write(out / 'classified_motion_ICs.txt', ','.join(map(str, ICs)))
+    for IC in ICs:
+        write(out / 'melodic.ica' / 'report' / f'IC_{IC}_thresh.png', PNG)
+    write(out / 'melodic.ica' / 'melodic_IC.nii.gz', nifti_header([64, 64, 36, 40]))
+    write(out / 'denoised_func_data_nonaggr.nii.gz', nifti_header([64, 64, 36, 200]))
+    if post:
+        feat = out / 'stats.feat'
+        write(feat / 'report_prestats.html', '<html></html>\n')
+        write(feat / 'cluster_zstat1.html', '<html></html>\n')
+        write(feat / 'rendered_thresh_zstat1.png', PNG)
+        write(feat / 'tsplot' / 'tsplot_zstat1.png', PNG)
+
+def make_database(root, subjects, tasks, processed=0.5, post=0.25, invalid=0.02, seed=1, volumes=200,
+                  prefix='_pre_AROMA', suffix='_AROMA_Output'):
+    rng = random.Random(seed)
+    root = Path(root)
+    runs = 0
+    for s in range(subjects):
+        session = root / f'sub{s:04d}' / 'ses1'
+        for task in tasks:
+            feat = session / f'{task}{prefix}.feat'
+            make_run(feat, rng, volumes, spiky=rng.random() < 0.05)
+            kind = rng.random()
+            if kind < invalid / 2:
+                os.remove(feat / 'report_prestats.html')
+            elif kind < invalid:
+                write(feat / 'cluster_zstat1.html', '<html></html>\n')
+            elif rng.random() < processed:
+                make_output(session / f'{task}{suffix}', rng, rng.random() < post / processed)
+            runs += 1
+    return runs
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description='build a synthetic database of FEAT preprocessed runs')
+    p.add_argument('root', help='directory to create the database in')
+    p.add_argument('--subjects', type=int, default=100)
+    p.add_argument('--tasks', default='rest,motor', help='comma separated task names (runs per subject)')
+    p.add_argument('--processed', type=float, default=0.5, help='share of runs with an ICA-AROMA output folder')
+    p.add_argument('--post', type=float, default=0.25, help='share of runs that are also post-processed')
+    p.add_argument('--volumes', type=int, default=200)
+    p.add_argument('--seed', type=int, default=1)
+    args = p.parse_args(argv)
+    runs = make_database(args.root, args.subjects, args.tasks.split(','), args.processed, args.post,
+                         seed=args.seed, volumes=args.volumes)
+    print(f'{runs} runs written to {args.root}')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
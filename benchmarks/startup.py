@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# INFOBAR Interface for batch processing ICA-AROMA
+# Benchmarks: times starting INFOBAR, from a fresh interpreter to the first paint of the main window
+# Copyright (C) 2020  Manish Anand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Each run starts a new interpreter, so every module is imported cold. Reported per stage (median of the runs):
+#   import       import INFOBAR (or infobar_cli with --cli)
+#   first paint  building MainApp until its window has been drawn (skipped without a display)
+#   total        wall time of the whole start, interpreter start-up included
+# Exits with status 1 when the median total is above --target seconds, so it can guard against slow imports.
+
+import argparse, json, statistics, subprocess, sys, time
+from pathlib import Path
+
+here = Path(__file__).resolve().parent
+
+# run in the child interpreter; prints one JSON line once the window is up
+child = r'''
+import json, sys, time
+t0 = time.perf_counter()
+sys.path.insert(0, {root!r})
+if {cli!r}:
+    import infobar_cli
+    print(json.dumps(dict(import_s=time.perf_counter() - t0)), flush=True)
+    sys.exit()
+import tkinter as tk
+import INFOBAR
+t1 = time.perf_counter()
+try:
+    root = tk.Tk()
+except tk.TclError:
+    print(json.dumps(dict(import_s=t1 - t0)), flush=True)
+    sys.exit()
+INFOBAR.MainApp(root)
+root.update()
+print(json.dumps(dict(import_s=t1 - t0, paint_s=time.perf_counter() - t1)), flush=True)
+root.destroy()
+'''
+
+# one start; the total is taken when the child reports, not when it has torn down
+def start(cli):
+    t0 = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, '-c', child.format(root=str(here.parent), cli=cli)],
+                            stdout=subprocess.PIPE, text=True)
+    line = proc.stdout.readline()
+    total = time.perf_counter() - t0
+    proc.communicate()
+    if proc.returncode != 0 or not line: raise SystemExit('INFOBAR failed to start')
+    return dict(json.loads(line), total_s=total)
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description='time INFOBAR start-up from a fresh interpreter to the first paint')
+    p.add_argument('--runs', type=int, default=5)
+    p.add_argument('--target', type=float, default=1.0, help='seconds the median total may take (default 1.0)')
+    p.add_argument('--cli', action='store_true', help='time importing the command line interface instead')
+    p.add_argument('--json', help='also write the results to this file as JSON')
+    args = p.parse_args(argv)
+
+    runs = [start(args.cli) for _ in range(args.runs)]
+    results = {}
+    for stage, key in (('import', 'import_s'), ('first paint', 'paint_s'), ('total', 'total_s')):
+        times = [run[key] for run in runs if key in run]
+        if times:
+            results[stage] = round(statistics.median(times), 3)
+            print(f'{stage:<12} {results[stage]:>7.3f} s   (min {min(times):.3f}, max {max(times):.3f})')
+        else:
+            print(f'{stage:<12}       -     (no display)')
+    ok = results['total'] <= args.target
+    print(f'target {args.target:.3f} s: {"ok" if ok else "too slow"}')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(dict(results, target=args.target, runs=args.runs, cli=args.cli), f, indent=1)
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+# INFOBAR Interface for batch processing ICA-AROMA
+# Command line interface: scan and process datasets without a display, e.g. from job scripts on compute nodes
+# Copyright (C) 2020  Manish Anand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import argparse, csv, json, os, signal, sys, threading, time
+from pathlib import Path
+from infobar_core import name, version, config, executor, search, dataset_record, appFuncs, record_query
+# the shared queue, watcher and QC export modules are imported by the commands that use them
+
+fields = ['inpath', 'outpath', 'abs', 'rel', 'mean_fd', 'max_fd', 'fd_pct', 'outlier', 'status']
+print_lock = threading.Lock()
+
+def record_row(record):
+    fd = record.fd or [None] * 3
+    return {'inpath': str(record.inpath), 'outpath': str(record.outpath), 'abs': str(record.motion[0]),
+            'rel': str(record.motion[1]), 'mean_fd': fd[0], 'max_fd': fd[1], 'fd_pct': fd[2],
+            'outlier': record.outlier, 'status': record.status()}
+
+# writes one line per dataset as JSON lines, CSV or TSV
+def write_records(records, fmt, out):
+    if fmt == 'json':
+        for record in records:
+            out.write(json.dumps(record_row(record)) + '\n')
+    else:
+        writer = csv.DictWriter(out, fields, delimiter=',' if fmt == 'csv' else '\t')
+        writer.writeheader()
+        for record in records:
+            writer.writerow(record_row(record))
+
+# reads the JSON lines written by 'scan'; '-' reads standard input
+def read_records(path):
+    f = sys.stdin if path == '-' else open(path)
+    records = []
+    try:
+        for line in f:
+            if line.strip() == '': continue
+            row = json.loads(line)
+            record = dataset_record(Path(row['inpath']), Path(row['outpath']))
+            record.motion = [row.get('abs', 0), row.get('rel', 0)]
+            record.read_output()
+            records.append(record)
+    finally:
+        if f is not sys.stdin: f.close()
+    return records
+
+def emit(file=None, **event):
+    with print_lock:
+        print(json.dumps(event), file=file, flush=True)
+
+# status of a job; finished jobs also report their exit code, times and peak memory
+def job_status(record, msg):
+    usage = record.usage if record.usage and msg not in ('Queued', 'Processing...') else {}
+    emit(event='status', inpath=str(record.inpath), outpath=str(record.outpath), status=msg,
+         **{k: v for k, v in usage.items() if k != 'started'})
+
+def select_records(args, conf):
+    if args.input:
+        records = read_records(args.input)
+    else:
+        records = search(args.root, args.task, args.filters, conf)
+    if args.unprocessed:
+        records = [record for record in records if record.pvp == 0]
+    return records
+
+def scan(args, conf):
+    records = select_records(args, conf)
+    write_records(records, args.format, sys.stdout)
+    return 0
+
+def process(args, conf):
+    records = select_records(args, conf)
+    if args.sweep is not None: conf.sweep = [den.strip() for den in args.sweep.split(',') if den.strip()]
+    use_metrics(args, conf)
+    t1 = time.perf_counter()
+    process_queue = executor(records, conf, int(args.overwrite), job_status, args.stale)
+    emit_estimate(process_queue, records)
+    control_signals(process_queue)
+    process_queue.threader()
+    table = process_queue.summary.path
+    emit(event='summary', jobs=len(records), seconds=round(time.perf_counter() - t1, 1), table=str(table) if table.exists() else None)
+    return 0
+
+# reruns the jobs the journal does not record as done
+def resume(args, conf):
+    if args.max_retries is not None: conf.max_retries = args.max_retries
+    use_metrics(args, conf)
+    process_queue = executor([], conf, 0, job_status)
+    que, exhausted = process_queue.resume_prep()
+    emit_estimate(process_queue, [job[1] for job in que])
+    control_signals(process_queue)
+    for entry in exhausted:
+        emit(event='skipped', inpath=entry['inpath'], status=f"Failed (exit {entry.get('code')})", attempts=entry.get('attempt'))
+    t1 = time.perf_counter()
+    process_queue.threader(que)
+    table = process_queue.summary.path
+    emit(event='summary', jobs=len(que), skipped=len(exhausted), seconds=round(time.perf_counter() - t1, 1),
+         table=str(table) if table.exists() else None)
+    return 0
+
+# signals controlling a running batch: SIGUSR1 pauses or continues, SIGINT drains (a second one cancels),
+# SIGTERM cancels; unfinished jobs stay in the journal for 'resume'
+def control_signals(process_queue):
+    def pause(signum, frame):
+        if process_queue.state == 'paused':
+            process_queue.unpause()
+        else:
+            process_queue.pause()
+        emit(event='control', state=process_queue.state)
+    def interrupt(signum, frame):
+        if process_queue.state == 'draining':
+            process_queue.cancel()
+        else:
+            process_queue.drain()
+        emit(event='control', state=process_queue.state)
+    def terminate(signum, frame):
+        process_queue.cancel()
+        emit(event='control', state=process_queue.state)
+    signal.signal(signal.SIGUSR1, pause)
+    signal.signal(signal.SIGINT, interrupt)
+    signal.signal(signal.SIGTERM, terminate)
+
+# expected duration of a batch, from job sizes and the runtimes of earlier jobs
+def emit_estimate(process_queue, records):
+    makespan, total = process_queue.estimate(records)
+    emit(event='estimate', jobs=len(records), slots=process_queue.scheduler.max_jobs, seconds=round(makespan),
+         job_seconds=round(total), finish=time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(time.time() + makespan)),
+         history=process_queue.model.samples)
+
+def shared_queue(args, conf):
+    path = args.queue or conf.queue_dir
+    if not path: raise SystemExit('no queue directory: use --queue or set queue_dir in settings.json')
+    from infobar_queue import work_queue
+    return work_queue(path, args.lease)
+
+# adds the selected datasets to a work queue on a shared filesystem
+def submit(args, conf):
+    queue = shared_queue(args, conf)
+    records = select_records(args, conf)
+    builder = executor(records, conf, int(args.overwrite), None)
+    # workers claim the oldest pending job first, so the longest jobs are submitted first
+    records.sort(key=lambda record: builder.model.seconds(record.job_cost()), reverse=True)
+    added = 0
+    for record in records:
+        if queue.submit(builder.job_args(record.inpath, record.outpath), record, appFuncs.job_memory(record.job_cost()), args.force):
+            added += 1
+        else:
+            emit(event='skipped', inpath=str(record.inpath), status='already in queue')
+    emit(event='summary', submitted=added, skipped=len(records) - added)
+    return 0
+
+# processes jobs from the queue until stopped, or until it is empty with --exit-when-empty
+def worker(args, conf):
+    from infobar_queue import queue_worker
+    use_metrics(args, conf)
+    node = queue_worker(shared_queue(args, conf), conf, args.exit_when_empty, emit)
+    control_signals(node.executor)
+    node.run()
+    return 0
+
+def queue_status(args, conf):
+    emit(**shared_queue(args, conf).status())
+    return 0
+
+# lists the selected datasets again whenever their processing state or motion changes on disk, until interrupted
+def watch(args, conf):
+    from infobar_watch import dataset_watcher
+    records = select_records(args, conf)
+    on_change = lambda changed: [emit(event='changed', **record_row(record)) for record in changed]
+    watcher = dataset_watcher(records, on_change, conf.fd_threshold, args.interval or conf.watch_interval).start()
+    emit(event='watching', datasets=len(records))
+    try:
+        while watcher.thread.is_alive(): watcher.thread.join(1)
+    except KeyboardInterrupt:
+        watcher.stop()
+    return 0
+
+# writes QC measures of every run in the database to CSV or Parquet while walking it
+def export(args, conf):
+    from infobar_export import qc_export
+    # progress goes to stderr when the table itself is written to stdout
+    out = sys.stderr if args.output == '-' else sys.stdout
+    progress = lambda count: emit(event='progress', written=count, file=out)
+    t1 = time.time()
+    try:
+        count = qc_export(args.root, args.task, args.output, conf, not args.all, args.workers or conf.scan_workers,
+                          args.window, progress)
+    except RuntimeError as e:
+        raise SystemExit(str(e))
+    emit(event='summary', written=count, output=args.output, seconds=round(time.time() - t1, 1), file=out)
+    return 0
+
+# checks that the output folders of the selected datasets are complete and queues the broken ones for 'resume'
+def verify(args, conf):
+    from infobar_verify import verify_outputs, requeue
+    records = select_records(args, conf)
+    t1 = time.time()
+    progress = lambda count: emit(event='progress', checked=count)
+    checked, broken = verify_outputs(records, conf, args.deep, args.workers or conf.scan_workers, progress=progress)
+    for record in broken:
+        emit(event='broken', inpath=str(record.inpath), outpath=str(record.outpath), problems=record.broken)
+    queued = 0 if args.no_requeue else requeue(broken, conf)
+    emit(event='summary', checked=len(checked), broken=len(broken), queued=queued, seconds=round(time.time() - t1, 1))
+    return 0
+
+def add_queue(parser):
+    parser.add_argument('--queue', help='queue directory on the shared filesystem (default: queue_dir in settings.json)')
+    parser.add_argument('--lease', type=int, default=600, help='seconds before a job of an unresponsive worker is reclaimed')
+
+def add_metrics(parser):
+    parser.add_argument('--metrics', help='file to keep job counts, jobs/hour and ETA in while running: Prometheus text '
+                                          'for a .prom file, JSON otherwise (default: metrics_path in settings)')
+    parser.add_argument('--metrics-interval', type=float, help='seconds between metrics updates (default: metrics_interval in settings)')
+
+# the metrics options go to the settings the executor reads
+def use_metrics(args, conf):
+    if args.metrics is not None: conf.metrics_path = args.metrics
+    if args.metrics_interval is not None: conf.metrics_interval = args.metrics_interval
+
+def add_selection(parser):
+    parser.add_argument('--root', default='.', help='database root directory')
+    parser.add_argument('--task', default='', help='task/dataset name to search for')
+    parser.add_argument('--filters', default='', help="query keeping matching datasets, e.g. 'abs > 1.5 and not processed', "
+                                                    "or semicolon separated path keywords/globs (any of them)")
+    parser.add_argument('--input', help="JSON lines written by 'scan' to use instead of searching ('-' for stdin)")
+    parser.add_argument('--unprocessed', action='store_true', help='only datasets without an ICA-AROMA output folder')
+
+def parser():
+    p = argparse.ArgumentParser(prog='infobar', description=f'{name} {version}: batch processing of ICA-AROMA without a display')
+    p.add_argument('--settings', help='settings.json to use (default: the one next to this program)')
+    p.add_argument('--version', action='version', version=f'{name} {version}')
+    sub = p.add_subparsers(dest='command', required=True)
+
+    s = sub.add_parser('scan', help='search the database and list datasets with motion and processing status')
+    add_selection(s)
+    s.add_argument('--format', choices=['json', 'csv', 'tsv'], default='json', help='output format (default: JSON lines)')
+    s.set_defaults(func=scan)
+
+    s = sub.add_parser('process', help='run ICA-AROMA on the selected datasets, reporting progress as JSON lines')
+    add_selection(s)
+    s.add_argument('--overwrite', action='store_true', help='overwrite existing ICA-AROMA outputs')
+    s.add_argument('--stale', action='store_true',
+                   help='skip outputs made from the current inputs and settings, rerun the other existing ones')
+    s.add_argument('--sweep', help="comma separated den values, each written to its own output folder with one MELODIC "
+                                   "run per dataset ('' for none; default: sweep in settings)")
+    add_metrics(s)
+    s.set_defaults(func=process)
+
+    s = sub.add_parser('resume', help='rerun jobs of an interrupted batch: skips completed ones, retries failed ones')
+    s.add_argument('--max-retries', type=int, help='retries per job before giving up (default: max_retries in settings)')
+    add_metrics(s)
+    s.set_defaults(func=resume)
+
+    s = sub.add_parser('submit', help='add the selected datasets to a shared work queue')
+    add_selection(s)
+    add_queue(s)
+    s.add_argument('--overwrite', action='store_true', help='overwrite existing ICA-AROMA outputs')
+    s.add_argument('--force', action='store_true', help='submit again datasets already in the queue')
+    s.set_defaults(func=submit)
+
+    s = sub.add_parser('worker', help='process jobs from a shared work queue')
+    add_queue(s)
+    s.add_argument('--exit-when-empty', action='store_true', help='stop once no jobs are pending')
+    add_metrics(s)
+    s.set_defaults(func=worker)
+
+    s = sub.add_parser('watch', help='report datasets whose processing state or motion changes, until interrupted')
+    add_selection(s)
+    s.add_argument('--interval', type=float, help='seconds between checks without inotify (default: watch_interval in settings)')
+    s.set_defaults(func=watch)
+
+    s = sub.add_parser('export', help='write QC measures of every processed run to a CSV or Parquet file')
+    s.add_argument('output', help="file to write: .parquet/.pq for Parquet (needs pyarrow), otherwise CSV; '-' for stdout")
+    s.add_argument('--root', default='.', help='database root directory')
+    s.add_argument('--task', default='', help='task/dataset name to search for')
+    s.add_argument('--all', action='store_true', help='also export runs without an ICA-AROMA output folder')
+    s.add_argument('--workers', type=int, help='runs read in parallel (default: scan_workers in settings)')
+    s.add_argument('--window', type=int, default=256, help='most runs read or waiting to be written at a time')
+    s.set_defaults(func=export)
+
+    s = sub.add_parser('verify', help="check that ICA-AROMA outputs are complete and queue broken ones for 'resume'")
+    add_selection(s)
+    s.add_argument('--deep', action='store_true', help='decompress every denoised image (checks its CRC) instead of '
+                                                      'only comparing its length with the header')
+    s.add_argument('--workers', type=int, help='outputs checked in parallel (default: scan_workers in settings)')
+    s.add_argument('--no-requeue', action='store_true', help='only report broken outputs')
+    s.set_defaults(func=verify)
+
+    s = sub.add_parser('queue-status', help='print job counts of a shared work queue')
+    add_queue(s)
+    s.set_defaults(func=queue_status)
+    return p
+
+def main(argv=None):
+    p = parser()
+    args = p.parse_args(argv)
+    # a query that cannot be read is reported before the database is searched
+    if getattr(args, 'filters', '').strip():
+        try:
+            record_query(args.filters)
+        except ValueError as e:
+            p.error(f'--filters: {e}')
+    conf = config(args.settings)
+    try:
+        return args.func(args, conf)
+    except BrokenPipeError:
+        # output closed early, e.g. piped into head
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,1640 @@
+# INFOBAR Interface for batch processing ICA-AROMA
+# Scanning, indexing and processing functions shared by the GUI and the command line
+# Copyright (C) 2020  Manish Anand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from pathlib import Path
+import json, threading, time, os, fnmatch, re, gzip, struct, csv, shutil, signal, heapq, zlib
+# concurrent.futures, sqlite3, subprocess and tempfile are imported where they are used, so starting the GUI stays fast
+
+name='INFOBAR'
+version='2.0'
+
+# limits for concurrent ICA-AROMA jobs; 0 for max_jobs/memory_gb means derived from the machine
+# scratch_dir: local directory for job outputs, moved into the database once finished ('' writes to the database)
+# scratch_gb: disk budget of the jobs staged there, 0 for 90% of its free space
+default_resources = {'max_jobs': 0, 'memory_gb': 0, 'threads_per_job': 1, 'nice': 0, 'scratch_dir': '', 'scratch_gb': 0}
+
+# helper class for settings
+class config:
+    def __init__(self, settings_path=None):
+        self.settings_path = Path(settings_path or Path(__file__).parent.absolute()/'settings.json')
+        self.readSettings()
+        self.allocate()
+
+    def readSettings(self):
+        with open(self.settings_path) as settingsFile:
+            self.settings_dict = json.load(settingsFile)
+
+    def allocate(self):
+        self.icaPath = self.settings_dict["icaPath"]
+        self.python = self.settings_dict.get('python', 'python2.7')     # interpreter that runs ICA_AROMA.py
+        self.prefeat_identifier = self.settings_dict['prefeat_identifier']
+        self.output_identifier = self.settings_dict['output_identifier']
+        self.user_options=self.settings_dict["user"]
+        self.default_options = self.settings_dict["defaults"]
+        self.scan_workers = self.settings_dict.get('scan_workers', 8)
+        self.resources = dict(default_resources, **self.settings_dict.get('resources', {}))
+        self.max_retries = self.settings_dict.get('max_retries', 2)
+        self.fd_threshold = self.settings_dict.get('fd_threshold', 0.5)
+        self.fingerprint_hash = self.settings_dict.get('fingerprint_hash', False)     # also hash inputs, slower
+        self.reuse_melodic = self.settings_dict.get('reuse_melodic', True)
+        self.sweep = self.settings_dict.get('sweep', [])         # den variants written to <output folder>_<den>
+        self.watch = self.settings_dict.get('watch', False)
+        self.watch_interval = self.settings_dict.get('watch_interval', 30)
+        self.journal_path = self.settings_path.parent/'infobar_journal.jsonl'
+        self.batch_dir = self.settings_path.parent/'batches'
+        self.queue_dir = self.settings_dict.get('queue_dir', '')
+        self.metrics_path = self.settings_dict.get('metrics_path', '')     # .prom for Prometheus text, else JSON
+        self.metrics_interval = self.settings_dict.get('metrics_interval', 15)
+        self.index_path = self.settings_path.parent/'infobar_index.sqlite'
+
+    def reverse_allocate(self):
+        self.settings_dict["icaPath"] = self.icaPath
+        self.settings_dict['python'] = self.python
+        self.settings_dict['prefeat_identifier'] = self.prefeat_identifier
+        self.settings_dict['output_identifier'] = self.output_identifier
+        self.settings_dict['user']=self.user_options
+        self.settings_dict['scan_workers'] = self.scan_workers
+        self.settings_dict['resources'] = self.resources
+        self.settings_dict['max_retries'] = self.max_retries
+        self.settings_dict['fd_threshold'] = self.fd_threshold
+        self.settings_dict['fingerprint_hash'] = self.fingerprint_hash
+        self.settings_dict['reuse_melodic'] = self.reuse_melodic
+        self.settings_dict['sweep'] = self.sweep
+        self.settings_dict['watch'] = self.watch
+        self.settings_dict['watch_interval'] = self.watch_interval
+        self.settings_dict['queue_dir'] = self.queue_dir
+        self.settings_dict['metrics_path'] = self.metrics_path
+        self.settings_dict['metrics_interval'] = self.metrics_interval
+
+    def writeSettings(self):
+        self.reverse_allocate()
+        with open(self.settings_path, 'w') as json_file:
+            json.dump(self.settings_dict, json_file)
+
+    def loadDefaults(self):
+        self.settings_dict["user"] = self.settings_dict["defaults"].copy()
+
+#-----------------------------------------------------------------------------------------------------------------------
+
+# searches root for preprocessed datasets of a task and returns their records
+# filters: a record_query, e.g. semicolon separated keywords keeping datasets whose path contains any of them
+def search(root, dataset, filters, config):
+    # path-only queries narrow the search before anything is read; motion and status terms need the data first
+    query = record_query(filters) if filters.strip() else None
+    index = dataset_index(config.index_path)
+    search_scan = scanner(root, dataset, config.scan_workers, index, config.prefeat_identifier, config.output_identifier)
+    search_list = search_scan.scan()
+    index.prune(search_scan.root, search_scan.identifier)
+    if query is not None and not query.uses_data:
+        search_list = query.filter(search_list)
+    fl = aggregated_list(search_list, index, config.fd_threshold, config.scan_workers)
+    flag_outliers(fl)
+    index.save()
+    if query is not None and query.uses_data:
+        fl = query.filter(fl)
+        for iid, record in enumerate(fl):
+            record.iid = iid
+    return fl
+
+# Checks if the selected dataset is a preprocessed dataset for one individual.
+# Filters out based on presence of a report_prestat.html file
+def verify_dataset(file_list):
+    fl = [dataset for dataset in file_list if appFuncs.is_prestats(dataset)]
+    return fl
+
+def apply_filters(file_list, filters):
+    if len(filters.strip()) != 0:
+        fl = record_query(filters).filter(file_list)
+    else:
+        fl = file_list
+    return fl
+
+#  class for filter queries over scanned records
+#  A query combines terms with 'and', 'or' (or ';'), 'not' and parentheses; adjacent terms are and-ed:
+#    sub01;sub02                    path contains sub01 or sub02
+#    rest and sub0?                 path contains rest and matches the glob *sub0?*
+#    abs > 1.5 and not processed    absolute motion above 1.5 mm, no ICA-AROMA output yet
+#    fdpct > 20 or outlier          over 20% of volumes above the FD threshold, or a group outlier
+#  Terms are comparisons of a numeric field, status keywords or path substrings/globs (quote a keyword to search it
+#  as text). The query is compiled once into nested closures, so filtering is one Python call per record.
+class record_query:
+    fields = {'abs': lambda r: float(r.motion[0]), 'rel': lambda r: float(r.motion[1]),
+              'fd': lambda r: r.fd[0] if r.fd else float('nan'),
+              'maxfd': lambda r: r.fd[1] if r.fd else float('nan'),
+              'fdpct': lambda r: r.fd[2] if r.fd else float('nan')}
+    keywords = {'processed': lambda r: r.pvp == 1,
+                'postprocessed': lambda r: r.pop == 1,
+                'post-processed': lambda r: r.pop == 1,
+                'failed': lambda r: (r.message or '').startswith('Failed'),
+                'running': lambda r: r.message == 'Processing...',
+                'outlier': lambda r: r.outlier,
+                'broken': lambda r: bool(r.broken)}
+    operators = {'>': float.__gt__, '<': float.__lt__, '>=': float.__ge__, '<=': float.__le__,
+                 '=': float.__eq__, '==': float.__eq__, '!=': float.__ne__}
+    token_pattern = re.compile(r'\s*(?:(?P<op>>=|<=|!=|==|=|>|<)|(?P<punct>[();])|"(?P<dq>[^"]*)"|\'(?P<sq>[^\']*)\'|(?P<word>[^\s();<>=!]+))')
+
+    def __init__(self, text):
+        self.text = text
+        self.tokens = self.tokenize(text)
+        self.position = 0
+        self.uses_data = False      # whether any term looks beyond the path
+        self.predicate = self.parse_or()
+        if self.position < len(self.tokens):
+            raise ValueError(f'unexpected {self.tokens[self.position][1]!r} in query')
+
+    def __call__(self, record):
+        return self.predicate(record)
+
+    def filter(self, records):
+        predicate = self.predicate
+        return [record for record in records if predicate(record)]
+
+    def tokenize(self, text):
+        tokens, position = [], 0
+        text = text.rstrip()
+        while position < len(text):
+            match = self.token_pattern.match(text, position)
+            if match is None or match.end() == position:
+                raise ValueError(f'cannot read query at {text[position:]!r}')
+            position = match.end()
+            kind = match.lastgroup
+            value = match.group(kind)
+            if kind in ('dq', 'sq'): kind = 'text'
+            tokens.append((kind, value))
+        return tokens
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def next(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def is_word(self, *words):
+        kind, value = self.peek()
+        return kind == 'word' and value.lower() in words
+
+    def parse_or(self):
+        terms, separator = [], None
+        while True:
+            # empty alternatives around ';', e.g. after a trailing one, are left out as they were before queries
+            empty = self.peek()[0] is None or self.peek() in (('punct', ')'), ('punct', ';'))
+            if not (empty and ('punct', ';') in (separator, self.peek())): terms.append(self.parse_and())
+            if not (self.is_word('or') or self.peek() == ('punct', ';')): break
+            separator = self.next()
+        if not terms: return lambda r: True
+        if len(terms) == 1: return terms[0]
+        return lambda r: any(term(r) for term in terms)
+
+    def parse_and(self):
+        terms = [self.parse_not()]
+        while True:
+            if self.is_word('and'):
+                self.next()
+            elif self.peek()[0] is None or self.peek() in (('punct', ')'), ('punct', ';')) or self.is_word('or'):
+                break
+            terms.append(self.parse_not())
+        if len(terms) == 1: return terms[0]
+        return lambda r: all(term(r) for term in terms)
+
+    def parse_not(self):
+        if self.is_word('not'):
+            self.next()
+            term = self.parse_not()
+            return lambda r: not term(r)
+        return self.parse_term()
+
+    def parse_term(self):
+        kind, value = self.next()
+        if kind is None:
+            raise ValueError('query ends unexpectedly')
+        if (kind, value) == ('punct', '('):
+            term = self.parse_or()
+            if self.next() != ('punct', ')'): raise ValueError('missing closing parenthesis in query')
+            return term
+        if kind == 'word' and value.lower() in self.fields and self.peek()[0] == 'op':
+            field = self.fields[value.lower()]
+            self.uses_data = True
+            compare = self.operators[self.next()[1]]
+            number_kind, number = self.next()
+            try:
+                threshold = float(number)
+            except (TypeError, ValueError):
+                raise ValueError(f'{value} must be compared with a number, not {number!r}')
+            return lambda r: compare(field(r), threshold)
+        if kind == 'word' and value.lower() in self.keywords:
+            self.uses_data = True
+            return self.keywords[value.lower()]
+        if kind in ('word', 'text'):
+            return self.path_term(value)
+        raise ValueError(f'unexpected {value!r} in query')
+
+    @staticmethod
+    def path_term(value):
+        if any(c in value for c in '*?['):
+            pattern = f'*{value}*'
+            return lambda r: fnmatch.fnmatchcase(str(r.inpath), pattern)
+        return lambda r: value in str(r.inpath)
+
+# completes the scanned records from the index, or from their output folder when it changed
+def aggregated_list(filtered_list, index, fd_threshold=0.5, workers=8):
+    fresh = []
+    for iid, record in enumerate(filtered_list):
+        record.iid = iid
+        if not index.lookup(record, fd_threshold):
+            record.read_output()
+            fresh.append(record)
+    # motion stats are read for all changed datasets at once
+    paths = [record.inpath for record in fresh]
+    fd = appFuncs.framewise_displacement(paths, fd_threshold, workers=workers)
+    for record, motion, record_fd in zip(fresh, appFuncs.headMotion_batch(paths), fd):
+        record.motion = motion
+        record.fd = record_fd
+        index.store(record, fd_threshold)
+    return filtered_list
+
+# marks runs whose mean framewise displacement lies above the upper Tukey fence (Q3 + 1.5 IQR) of the group
+def flag_outliers(records, min_group=4):
+    runs = [record for record in records if record.fd is not None]
+    for record in records:
+        record.outlier = False
+    if len(runs) < min_group: return
+    import numpy as np
+    q1, q3 = np.percentile([record.fd[0] for record in runs], [25, 75])
+    fence = q3 + 1.5 * (q3 - q1)
+    for record in runs:
+        record.outlier = bool(record.fd[0] > fence)
+
+#   helper class for common use functions
+class appFuncs:
+
+    # dimensions (dim[1..dim[0]]) and bits per voxel from a NIfTI-1 header, None if it cannot be read
+    # with offset, also the byte offset of the voxel data (vox_offset)
+    @staticmethod
+    def nifti_header(path, offset=False):
+        path = str(path)
+        try:
+            with (gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')) as f:
+                hdr = f.read(348)
+        except (OSError, EOFError, zlib.error):
+            return None
+        if len(hdr) < 348: return None
+        for endian in '<>':
+            if struct.unpack(endian + 'i', hdr[:4])[0] == 348:
+                dim = struct.unpack(endian + '8h', hdr[40:56])
+                bitpix = struct.unpack(endian + 'h', hdr[72:74])[0]
+                if not 0 < dim[0] <= 7: return None
+                if offset: return list(dim[1:dim[0] + 1]), bitpix, struct.unpack(endian + 'f', hdr[108:112])[0]
+                return list(dim[1:dim[0] + 1]), bitpix
+        return None
+
+    # size of a job for runtime estimates: voxels x volumes of filtered_func_data, None if unknown
+    @staticmethod
+    def job_cost(inpath):
+        header = appFuncs.nifti_header(Path(inpath)/'filtered_func_data.nii.gz')
+        if header is None: return None
+        cost = 1
+        for n in header[0][:4]: cost *= max(n, 1)
+        return cost
+
+    # rough peak memory of an ICA-AROMA job in bytes from its cost (dataset_record.job_cost, 0 if unknown): MELODIC
+    # keeps a few float copies of the 4D data
+    @staticmethod
+    def job_memory(cost):
+        if not cost: return 2 * 2**30
+        return 2**30 + 3 * 4 * cost
+
+    # generates output folder path
+    @staticmethod
+    def generateOutpath(inPath, prefix, suffix):
+        z=inPath.stem.replace(prefix,'');  z=z+suffix
+        outPath = (Path(inPath).parent) / z
+        return outPath
+
+    @staticmethod
+    def generateProcessedOutpath(path):
+        fo=Path(path).glob('*.feat')
+        processedOutpath=''
+        for i in fo:
+           processedOutpath=i
+        return processedOutpath
+
+    # Identify previously processed datasets
+    @staticmethod
+    def prevProcessed(outPath):
+        pvp = 0
+        if Path(outPath).is_dir(): pvp = 1
+        return pvp
+
+    @staticmethod
+    def postProcessed(path):
+        # idenitfy if the dataset has been processed through ICA and post-processed as well
+        pop = 0
+        # is feat file present?
+        # print(path)
+        fo=Path(path).glob('*.feat')
+        for i in fo:
+            if i.is_dir() == True:
+                pop = 1
+        return pop
+
+    @staticmethod
+    def postProcessed_identifier(path):
+        # if melodic.ica is a sibling directory, then this is assumed to be post-processed dataset generated from
+        # ICA-AROMA processed data
+        pop_i = 0
+        fo = Path(path).parent/'melodic.ica'
+        if fo.is_dir() == True: pop_i = 1
+        return pop_i
+
+    # a preprocessed dataset has a report_prestats.html but no cluster_zstat1.html (post-stats)
+    # a single directory listing answers both questions
+    @staticmethod
+    def is_prestats(path):
+        try:
+            with os.scandir(path) as it:
+                names = {entry.name for entry in it}
+        except OSError:
+            return False
+        return 'report_prestats.html' in names and 'cluster_zstat1.html' not in names
+
+    # files of a .feat folder that ICA-AROMA reads; a change in any of them makes its output stale
+    feat_inputs = ['filtered_func_data.nii.gz', 'mask.nii.gz', 'mc/prefiltered_func_data_mcf.par',
+                   'reg/example_func2highres.mat', 'reg/highres2standard.mat', 'reg/highres2standard_warp.nii.gz']
+
+    # size and mtime of every input present, and its SHA-256 with digest=True
+    @staticmethod
+    def input_fingerprint(inpath, digest=False):
+        inputs = {}
+        for name in appFuncs.feat_inputs:
+            path = Path(inpath)/name
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            inputs[name] = entry = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+            if digest: entry['sha256'] = appFuncs.file_digest(path)
+        return inputs
+
+    @staticmethod
+    def file_digest(path):
+        import hashlib
+        h = hashlib.sha256()
+        try:
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    h.update(block)
+        except OSError:
+            return None
+        return h.hexdigest()
+
+    # fingerprint written into an output folder by the job that produced it, None if there is none
+    @staticmethod
+    def read_fingerprint(outpath):
+        try:
+            with open(Path(outpath)/'infobar_fingerprint.json') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    # motion components listed by ICA-AROMA in classified_motion_ICs.txt (1-based, last line wins)
+    @staticmethod
+    def motion_ICs(outpath):
+        ICs = []
+        try:
+            with open(Path(outpath)/'classified_motion_ICs.txt') as f:
+                for line in f:
+                    line = line.strip()
+                    if line: ICs = [int(IC) for IC in line.split(',') if IC.strip()]
+        except (OSError, ValueError):
+            pass
+        return ICs
+
+    @staticmethod
+    def headMotion_stats(path):
+        # mean absolute and relative displacement, preferably from the MCFLIRT output itself
+        motion = [0, 0]
+        if path.is_dir():
+            motion = appFuncs.rms_motion(path)
+            if motion is None: motion = appFuncs.report_motion(path)
+        return motion
+
+    # head motion of many datasets; large batches are spread over a process pool
+    @staticmethod
+    def headMotion_batch(paths, workers=None, min_batch=256):
+        if len(paths) < min_batch:
+            return [appFuncs.headMotion_stats(path) for path in paths]
+        import concurrent.futures
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(appFuncs.headMotion_stats, paths, chunksize=64))
+
+    # framewise displacement (Power et al. 2012) of many runs from MCFLIRT's mc/prefiltered_func_data_mcf.par:
+    # rotations (columns 1-3, radians) count as arcs on a 50 mm sphere, translations (columns 4-6) are in mm.
+    # All runs are parsed into one array and reduced per run with reduceat.
+    # Returns [mean FD, max FD, % of volumes above threshold] per run, None for runs without a usable .par file
+    @staticmethod
+    def framewise_displacement(paths, threshold=0.5, radius=50.0, workers=8):
+        result = [None] * len(paths)
+        try:
+            import numpy as np
+        except ImportError:
+            return result
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            par = list(pool.map(appFuncs.read_par, paths))
+        runs = [i for i, p in enumerate(par) if p is not None and len(p) >= 2]
+        if not runs: return result
+        frames = np.array([len(par[i]) for i in runs])
+        params = np.concatenate([par[i] for i in runs])
+        params[:, :3] *= radius
+        fd = np.abs(np.diff(params, axis=0)).sum(axis=1)
+        fd = np.delete(fd, np.cumsum(frames)[:-1] - 1)     # differences between the last and first volume of two runs
+        steps = frames - 1
+        starts = np.concatenate(([0], np.cumsum(steps)[:-1]))
+        mean = np.add.reduceat(fd, starts) / steps
+        peak = np.maximum.reduceat(fd, starts)
+        above = np.add.reduceat(fd > threshold, starts) * 100.0 / steps
+        for k, i in enumerate(runs):
+            result[i] = [round(float(mean[k]), 3), round(float(peak[k]), 3), round(float(above[k]), 1)]
+        return result
+
+    # mc/prefiltered_func_data_mcf.par as an array of one row per volume; None if missing or malformed
+    @staticmethod
+    def read_par(path):
+        import numpy as np
+        try:
+            with open(Path(path)/'mc'/'prefiltered_func_data_mcf.par') as f:
+                values = np.array(f.read().split(), dtype=float)
+        except (OSError, ValueError):
+            return None
+        if len(values) % 6 != 0: return None
+        return values.reshape(-1, 6)
+
+    # reads mc/prefiltered_func_data_mcf_{abs,rel}_mean.rms
+    # values are truncated to two decimals the way FEAT writes them into report_prestats.html
+    @staticmethod
+    def rms_motion(path):
+        motion = []
+        for kind in ('abs', 'rel'):
+            try:
+                with open(path/'mc'/f'prefiltered_func_data_mcf_{kind}_mean.rms') as f:
+                    value = float(f.read().split()[0])
+            except (OSError, ValueError, IndexError):
+                return None
+            motion.append(str(int(value * 100) / 100.0))
+        return motion
+
+    motion_pattern = re.compile(r'absolute=([^,<]*?)mm,?\s*relative=([^,<]*?)mm')
+
+    # fallback: streams report_prestats.html and keeps the last 'absolute=..mm, relative=..mm' statement
+    @staticmethod
+    def report_motion(path):
+        motion = [0, 0]
+        try:
+            with open(path/'report_prestats.html', encoding='utf8', errors='replace') as f:
+                for line in f:
+                    for match in appFuncs.motion_pattern.finditer(line):
+                        motion = [match.group(1), match.group(2)]
+        except OSError:
+            pass
+        if motion == [0, 0]: motion = appFuncs.report_motion_bs4(path)
+        return motion
+
+    # last resort for unusual report layouts, only when BeautifulSoup is installed
+    @staticmethod
+    def report_motion_bs4(path):
+        try:
+            from bs4 import BeautifulSoup
+        except ImportError:
+            return [0, 0]
+        try:
+            with open(path/'report_prestats.html', encoding='utf8') as f:
+                soup = BeautifulSoup(f, 'lxml')
+            W=soup.find_all('p')[-4]
+            E=''.join(W.find('br').next_siblings)
+            S=E.split('mm')
+            motion=[S[0].split('=')[1],S[1].split('=')[1]]
+        except:
+            motion=[0,0]
+        return motion
+
+#  class for locating preprocessed datasets in the database
+#  Walks the tree with os.scandir, never descending into .feat or .ica folders (mc/, reg/, logs/, melodic.ica ...),
+#  and lists sibling directories concurrently on a bounded pool of threads
+class scanner:
+    def __init__(self, root, dataset='', workers=8, index=None, prefix='_pre_AROMA', suffix='_AROMA_Output'):
+        self.root = Path(root)
+        self.identifier = f'*{dataset}*.feat'
+        if dataset == '': self.identifier = '*.feat'
+        self.workers = max(1, int(workers))
+        self.index = index
+        self.prefix = prefix
+        self.suffix = suffix
+
+    def scan(self):
+        return sorted(self.iterate(), key=lambda record: record.inpath)
+
+    # yields records as their directories are listed, in no particular order
+    # only a few listings per worker run ahead of the caller; the other directories wait as paths, depth first
+    def iterate(self):
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            waiting, pending = [self.root], set()
+            while waiting or pending:
+                while waiting and len(pending) < self.workers * 4:
+                    pending.add(pool.submit(self.scan_dir, waiting.pop()))
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    matches, subdirs = future.result()
+                    waiting.extend(subdirs)
+                    yield from matches
+
+    # lists one directory: returns records of the datasets found in it and the sub-directories left to walk
+    def scan_dir(self, path):
+        matches, subdirs = [], []
+        try:
+            with os.scandir(path) as it:
+                entries = list(it)
+        except OSError:
+            return matches, subdirs
+        dirs = {}
+        for entry in entries:
+            try:
+                if entry.is_dir(): dirs[entry.name] = entry
+            except OSError:
+                continue
+        # a sibling melodic.ica marks an ICA-AROMA output folder: its .feat folders are post-processed results
+        aroma_output = 'melodic.ica' in dirs
+        for name, entry in dirs.items():
+            if name.endswith('.feat'):
+                if not aroma_output and fnmatch.fnmatchcase(name, self.identifier) and self.verify(path / name, entry):
+                    matches.append(self.record(path / name, dirs))
+            elif not name.endswith('.ica') and not entry.is_symlink():
+                subdirs.append(path / name)
+        return matches, subdirs
+
+    # new record for a dataset; the output folder, if any, is a sibling already listed in dirs
+    def record(self, inpath, dirs):
+        record = dataset_record(inpath, appFuncs.generateOutpath(inpath, self.prefix, self.suffix))
+        out = dirs.get(record.outpath.name)
+        if out is not None:
+            try:
+                record.out_mtime = out.stat().st_mtime_ns
+            except OSError:
+                pass
+        return record
+
+    # checks a candidate .feat folder, reusing the indexed answer while the folder is unchanged
+    def verify(self, path, entry):
+        if self.index is None:
+            return appFuncs.is_prestats(path)
+        try:
+            mtime = entry.stat().st_mtime_ns
+        except OSError:
+            return False
+        valid = self.index.valid(path, mtime)
+        if valid is None:
+            valid = appFuncs.is_prestats(path)
+            self.index.set_valid(path, mtime, valid)
+        return valid
+
+#  class for one dataset (a preprocessed .feat folder) and the state of its ICA-AROMA output
+class dataset_record:
+    __slots__ = ('inpath', 'outpath', 'motion', 'pvp', 'pop', 'postpath', 'out_mtime', 'iid', 'message', 'motion_ics',
+                 'fd', 'outlier', 'usage', 'cost', 'broken')
+
+    def __init__(self, inpath, outpath):
+        self.inpath = inpath
+        self.outpath = outpath
+        self.motion = [0, 0]
+        self.fd = None          # [mean FD, max FD, % of volumes above threshold], None without a .par file
+        self.outlier = False    # mean FD far above the rest of the search results
+        self.pvp = 0            # ICA-AROMA output folder present
+        self.pop = 0            # post-processed .feat present in the output folder
+        self.postpath = ''      # that post-processed .feat folder
+        self.out_mtime = None   # mtime of the output folder when it was last read
+        self.iid = None         # row in the result window, None when not displayed
+        self.message = None     # latest processing message, shown instead of status() while set
+        self.usage = None       # wall time, CPU time, peak memory and exit code of its last job
+        self.cost = None        # voxels x volumes of the run, 0 if unknown, read on first use
+        self.motion_ics = None  # motion components of the output folder, read on first use
+        self.broken = None      # problems found by verifying the output folder, None until verified
+
+    # reads processing state with a single listing of the output folder
+    def read_output(self):
+        self.pvp = self.pop = 0
+        self.postpath = ''
+        self.motion_ics = None
+        self.broken = None
+        try:
+            with os.scandir(self.outpath) as it:
+                feats = sorted(entry.name for entry in it if entry.name.endswith('.feat') and entry.is_dir())
+        except OSError:
+            return
+        self.pvp = 1
+        if feats:
+            self.pop = 1
+            self.postpath = self.outpath / feats[-1]
+
+    def motion_components(self):
+        if self.motion_ics is None:
+            self.motion_ics = appFuncs.motion_ICs(self.outpath)
+        return self.motion_ics
+
+    def job_cost(self):
+        if self.cost is None:
+            self.cost = appFuncs.job_cost(self.inpath) or 0
+        return self.cost
+
+    def status(self):
+        if self.pvp == 0: return 'Not Processed'
+        if self.broken: return 'Broken'
+        if self.pop == 0: return 'Processed'
+        return 'Post-Processed'
+
+#  class for the persistent dataset index stored next to settings.json
+#  Rows are keyed by .feat path and the mtimes of the .feat and output folders; a search re-reads a dataset only
+#  when one of those folders changed. The table is held in memory during a search and written back by save()
+class dataset_index:
+    columns = ['path', 'feat_mtime', 'valid', 'outpath', 'out_mtime', 'abs', 'rel', 'pvp', 'pop', 'postpath',
+               'fd_threshold', 'mean_fd', 'max_fd', 'fd_pct']
+    schema = 3
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.rows = {}
+        self.dirty = set()
+        self.removed = set()
+        self.seen = set()
+        self.lock = threading.Lock()
+        self.load()
+
+    def connect(self):
+        import sqlite3
+        con = sqlite3.connect(str(self.path))
+        # the index is only a cache: rebuild it when the layout changes
+        if con.execute('PRAGMA user_version').fetchone()[0] != self.schema:
+            con.execute('DROP TABLE IF EXISTS datasets')
+            con.execute(f'PRAGMA user_version = {self.schema}')
+        con.execute('CREATE TABLE IF NOT EXISTS datasets (path TEXT PRIMARY KEY, feat_mtime INTEGER, valid INTEGER, '
+                    'outpath TEXT, out_mtime INTEGER, abs TEXT, rel TEXT, pvp INTEGER, pop INTEGER, postpath TEXT, '
+                    'fd_threshold REAL, mean_fd REAL, max_fd REAL, fd_pct REAL)')
+        return con
+
+    def load(self):
+        import sqlite3
+        try:
+            con = self.connect()
+            try:
+                for row in con.execute(f'SELECT {", ".join(self.columns)} FROM datasets'):
+                    self.rows[row[0]] = list(row)
+            finally:
+                con.close()
+        except sqlite3.Error as e:
+            print(f'Dataset index unavailable, searching without it: {e}')
+
+    def save(self):
+        if not self.dirty and not self.removed: return
+        import sqlite3
+        try:
+            con = self.connect()
+            try:
+                with con:
+                    con.executemany('DELETE FROM datasets WHERE path = ?', [(p,) for p in self.removed])
+                    con.executemany(f'INSERT OR REPLACE INTO datasets VALUES ({", ".join("?" * len(self.columns))})',
+                                    [self.rows[p] for p in self.dirty if p in self.rows])
+            finally:
+                con.close()
+        except sqlite3.Error as e:
+            print(f'Could not update dataset index: {e}')
+        self.dirty.clear()
+        self.removed.clear()
+
+    # validity of a .feat folder if it is indexed with the same mtime, otherwise None
+    def valid(self, path, mtime):
+        key = os.path.abspath(path)
+        with self.lock:
+            self.seen.add(key)
+            row = self.rows.get(key)
+        if row is None or row[1] != mtime: return None
+        return bool(row[2])
+
+    def set_valid(self, path, mtime, valid):
+        key = os.path.abspath(path)
+        with self.lock:
+            self.rows[key] = [key, mtime, int(valid)] + [None] * (len(self.columns) - 3)
+            self.dirty.add(key)
+
+    # fills a record from the index if its output folder is unchanged; returns False when it must be re-read
+    def lookup(self, record, fd_threshold=0.5):
+        row = self.rows.get(os.path.abspath(record.inpath))
+        if row is None or row[7] is None or row[3] != os.path.abspath(record.outpath) or row[4] != record.out_mtime \
+                or row[10] != fd_threshold:
+            return False
+        record.motion = [row[5], row[6]]
+        record.pvp, record.pop = row[7], row[8]
+        record.postpath = Path(row[9]) if row[9] else ''
+        record.fd = None if row[11] is None else row[11:14]
+        return True
+
+    def store(self, record, fd_threshold=0.5):
+        key = os.path.abspath(record.inpath)
+        row = self.rows.setdefault(key, [key, None, 1] + [None] * (len(self.columns) - 3))
+        row[3:] = [os.path.abspath(record.outpath), record.out_mtime, str(record.motion[0]), str(record.motion[1]),
+                   record.pvp, record.pop, str(record.postpath), fd_threshold] + (record.fd or [None] * 3)
+        self.dirty.add(key)
+
+    # forget datasets under root that matched the search pattern but were not found again
+    def prune(self, root, identifier):
+        prefix = os.path.join(os.path.abspath(root), '')
+        for key in list(self.rows):
+            if key.startswith(prefix) and key not in self.seen and fnmatch.fnmatchcase(Path(key).name, identifier):
+                del self.rows[key]
+                self.removed.add(key)
+                self.dirty.discard(key)
+
+#  class for admitting ICA-AROMA jobs within CPU and memory limits of the node
+#  A job starts once fewer than max_jobs are running and its memory estimate fits in the remaining budget;
+#  a job larger than the whole budget still runs, but alone
+class scheduler:
+    def __init__(self, resources):
+        cpus = os.cpu_count() or 1
+        self.threads = max(1, int(resources.get('threads_per_job') or 1))
+        self.max_jobs = int(resources.get('max_jobs') or 0) or max(1, cpus // self.threads)
+        memory = float(resources.get('memory_gb') or 0) * 2**30
+        self.memory = memory or 0.8 * self.physical_memory()
+        self.nice = int(resources.get('nice') or 0)
+        self.running = 0
+        self.reserved = 0
+        self.cond = threading.Condition()
+
+    @staticmethod
+    def physical_memory():
+        try:
+            return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+        except (ValueError, OSError, AttributeError):
+            return 16 * 2**30
+
+    def acquire(self, need):
+        with self.cond:
+            while self.running and (self.running >= self.max_jobs or self.reserved + need > self.memory):
+                self.cond.wait()
+            self.running += 1
+            self.reserved += need
+
+    def release(self, need):
+        with self.cond:
+            self.running -= 1
+            self.reserved -= need
+            self.cond.notify_all()
+
+    # environment capping the threads MELODIC and the numerical libraries of each job may start
+    def environment(self):
+        env = dict(os.environ)
+        for var in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS',
+                    'NUMEXPR_NUM_THREADS', 'FSL_NUM_THREADS'):
+            env[var] = str(self.threads)
+        return env
+
+    # the job's command, started through nice(1) when a niceness is set: a preexec_fn could deadlock, as jobs are
+    # started from several threads
+    def command(self, args):
+        if not self.nice: return args
+        return ['nice', '-n', str(self.nice)] + list(args)
+
+#  class for sharing a local scratch directory between jobs within a disk budget
+#  Like the scheduler's memory budget: a job starts once its estimated output fits in what is left, and a job larger
+#  than the whole budget still runs, but alone. Staging folders left by INFOBAR processes that are gone are removed.
+class scratch_space:
+    bytes_per_voxel = 12         # float32 input read by MELODIC, its components and the denoised outputs
+    unknown_need = 2 * 2**30     # jobs whose size cannot be read from their header
+
+    def __init__(self, path, budget_gb=0):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.sweep()
+        self.budget = float(budget_gb or 0) * 2**30 or 0.9 * shutil.disk_usage(self.path).free
+        self.staged = 0
+        self.reserved = 0
+        self.cond = threading.Condition()
+
+    def need(self, record):
+        return record.job_cost() * self.bytes_per_voxel or self.unknown_need
+
+    def acquire(self, need):
+        with self.cond:
+            while self.staged and self.reserved + need > self.budget:
+                self.cond.wait()
+            self.staged += 1
+            self.reserved += need
+
+    def release(self, need):
+        with self.cond:
+            self.staged -= 1
+            self.reserved -= need
+            self.cond.notify_all()
+
+    # new staging folder infobar_<pid>_*, so sweep() can tell which are still in use
+    def folder(self):
+        import tempfile
+        return Path(tempfile.mkdtemp(prefix=f'infobar_{os.getpid()}_', dir=self.path))
+
+    def sweep(self):
+        for entry in self.path.glob('infobar_*_*'):
+            try:
+                os.kill(int(entry.name.split('_')[1]), 0)
+                continue
+            except ValueError:
+                continue
+            except ProcessLookupError:
+                shutil.rmtree(entry, ignore_errors=True)
+            except OSError:
+                continue        # running, under another user
+
+#  class for the append-only job journal stored next to settings.json
+#  One JSON line per state change (queued, running, done, failed) of a job, keyed by its output folder and flushed
+#  to disk immediately, so an interrupted batch can be resumed from the last state of every job
+class job_journal:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        self.on_write = None        # on_write(record, state, entry) after every entry, e.g. batch_metrics.update
+
+    def write(self, record, state, **fields):
+        entry = dict(time=round(time.time(), 3), inpath=str(record.inpath), outpath=str(record.outpath), state=state, **fields)
+        line = json.dumps(entry) + '\n'
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+        if self.on_write is not None: self.on_write(record, state, entry)
+
+    # last entry of every job, in order of first appearance
+    def last_states(self):
+        states = {}
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue    # torn last line after a crash
+                    states[entry['outpath']] = entry
+        except OSError:
+            pass
+        return states
+
+    # all entries in a given state, oldest first
+    def entries(self, state):
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    if entry.get('state') == state: yield entry
+        except OSError:
+            return
+
+    # jobs to resume: everything not done (or skipped as up to date), except failures that used up their retries
+    def unfinished(self, max_retries):
+        pending, exhausted = [], []
+        for entry in self.last_states().values():
+            if entry['state'] in ('done', 'skipped'): continue
+            if entry['state'] == 'failed' and entry.get('attempt', 0) > max_retries:
+                exhausted.append(entry)
+            else:
+                pending.append(entry)
+        return pending, exhausted
+
+#  class for live counters of a batch: jobs per state, throughput and the expected time to finish
+#  Fed by the journal's entries. The ETA spreads the predicted time of the queued jobs and the rest of the running
+#  ones over the job slots, with predictions scaled by how long this batch's completed jobs took against theirs.
+#  With a path, the counters are also written there every `interval` seconds while the batch runs: in Prometheus
+#  text format for a .prom file (e.g. for node_exporter's textfile collector), as JSON otherwise
+class batch_metrics:
+    states = ('queued', 'running', 'done', 'failed', 'cancelled', 'skipped')
+    gauges = [('jobs_per_hour', 'Jobs completed per hour since the batch started'),
+              ('eta_seconds', 'Expected seconds until the batch finishes'),
+              ('elapsed_seconds', 'Seconds since the batch started'),
+              ('active', '1 while the batch runs'),
+              ('time', 'Unix time of these values')]
+
+    def __init__(self, model, slots, path='', interval=15):
+        self.model = model
+        self.slots = slots
+        self.path = path
+        self.interval = interval
+        self.jobs = {}              # outpath -> [state, predicted seconds, start time of the running attempt]
+        self.actual = 0.0           # wall time of this batch's completed jobs
+        self.predicted = 0.0        # and what was predicted for them
+        self.started = None
+        self.finished = None
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def update(self, record, state, entry):
+        with self.lock:
+            job = self.jobs.get(entry['outpath'])
+            if job is None:
+                job = self.jobs[entry['outpath']] = [state, self.model.seconds(record.job_cost()), None]
+            job[0] = state
+            if state == 'running': job[2] = entry['time']
+            if state == 'done' and entry.get('wall_s'):
+                self.actual += entry['wall_s']
+                self.predicted += job[1]
+
+    def snapshot(self):
+        now = time.time()
+        with self.lock:
+            counts = dict.fromkeys(self.states, 0)
+            for state, seconds, started in self.jobs.values(): counts[state] += 1
+            scale = self.actual / self.predicted if self.predicted else 1.0
+            left = [seconds * scale if state == 'queued' else max(seconds * scale - (now - started), 0)
+                    for state, seconds, started in self.jobs.values() if state == 'queued' or state == 'running']
+        elapsed = (self.finished or now) - self.started if self.started else 0.0
+        return dict(counts, jobs_per_hour=round(counts['done'] * 3600 / elapsed, 2) if elapsed > 0 else 0.0,
+                    eta_seconds=round(self.model.makespan(left, self.slots)) if left and not self.finished else 0,
+                    elapsed_seconds=round(elapsed), active=int(self.started is not None and self.finished is None),
+                    time=round(now, 3))
+
+    def start(self):
+        self.started = time.time()
+        self.finished = None
+        if self.path:
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def finish(self):
+        self.finished = time.time()
+        self.stop_event.set()
+        if self.thread is not None: self.thread.join()
+        if self.path: self.write()
+
+    def run(self):
+        self.write()
+        while not self.stop_event.wait(self.interval):
+            self.write()
+
+    # replaced atomically, so a collector never reads a half written file
+    def write(self):
+        snap = self.snapshot()
+        text = self.prometheus(snap) if str(self.path).endswith('.prom') else json.dumps(snap) + '\n'
+        try:
+            with open(f'{self.path}.tmp', 'w') as f:
+                f.write(text)
+            os.replace(f'{self.path}.tmp', self.path)
+        except OSError as e:
+            print(f'Could not write metrics to {self.path}: {e}')
+
+    def prometheus(self, snap):
+        lines = ['# HELP infobar_jobs ICA-AROMA jobs of the batch by state', '# TYPE infobar_jobs gauge']
+        lines += [f'infobar_jobs{{state="{state}"}} {snap[state]}' for state in self.states]
+        for key, text in self.gauges:
+            metric = 'infobar_batch_active' if key == 'active' else f'infobar_{key}'
+            lines += [f'# HELP {metric} {text}', f'# TYPE {metric} gauge', f'{metric} {snap[key]}']
+        return '\n'.join(lines) + '\n'
+
+#  class for predicting ICA-AROMA runtimes as overhead + rate x job cost (voxels x volumes of the input)
+#  The line is fitted to the wall times of the latest completed jobs in the journal; without history it assumes a
+#  rate typical of MELODIC on one core. Jobs of unknown size are assumed to take as long as a typical past job.
+class runtime_model:
+    rate = 3e-5             # seconds per voxel-volume
+    overhead = 60.0         # seconds
+    history = 500
+
+    def __init__(self, journal):
+        points = [(entry['cost'], entry['wall_s']) for entry in journal.entries('done')
+                  if entry.get('cost') and entry.get('wall_s')][-self.history:]
+        self.samples = len(points)
+        if points: self.fit(points)
+        walls = sorted(wall for cost, wall in points)
+        self.typical = walls[len(walls) // 2] if walls else self.seconds(64 * 64 * 36 * 200)
+
+    def fit(self, points):
+        n = len(points)
+        mean_cost = sum(c for c, w in points) / n
+        mean_wall = sum(w for c, w in points) / n
+        var = sum((c - mean_cost) ** 2 for c, w in points)
+        if n >= 3 and var > 0:
+            rate = sum((c - mean_cost) * (w - mean_wall) for c, w in points) / var
+            overhead = mean_wall - rate * mean_cost
+            if rate > 0 and overhead >= 0:
+                self.rate, self.overhead = rate, overhead
+                return
+        # too few or too similar jobs for a line: proportional to size
+        self.rate, self.overhead = mean_wall / mean_cost, 0.0
+
+    def seconds(self, cost):
+        if not cost: return self.typical
+        return self.overhead + self.rate * cost
+
+    # finish time of jobs of the given durations started longest first on a number of slots
+    @staticmethod
+    def makespan(durations, slots):
+        finish = [0.0] * max(1, slots)
+        for duration in sorted(durations, reverse=True):
+            heapq.heappush(finish, heapq.heappop(finish) + duration)
+        return max(finish)
+
+#  class for the resource usage table of a batch, one CSV row per job attempt
+#  The file is created by the first finished attempt, so a batch that runs nothing leaves no file behind
+class batch_summary:
+    columns = ['inpath', 'outpath', 'attempt', 'code', 'started', 'cost', 'wall_s', 'user_s', 'sys_s', 'maxrss_mb', 'log']
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+
+    def write(self, record, usage):
+        row = dict(usage, inpath=str(record.inpath), outpath=str(record.outpath))
+        with self.lock:
+            try:
+                new = not self.path.exists()
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                with open(self.path, 'a', newline='') as f:
+                    writer = csv.DictWriter(f, self.columns, extrasaction='ignore')
+                    if new: writer.writeheader()
+                    writer.writerow(row)
+            except OSError as e:
+                print(f'Could not write batch summary: {e}')
+
+#  class for parallelization and execution
+#  With stale_only, runs whose output folder holds a fingerprint matching their inputs and ICA-AROMA options are
+#  skipped, and the other existing outputs are rerun with -overwrite
+#  With a sweep of den values, every run is processed once per value: the first into its output folder, the others
+#  into <output folder>_<den>, reusing the first one's MELODIC decomposition
+class executor:
+    def __init__(self, list, config, overwrite, status, stale_only=False):
+        self.fl = list
+        self.stale_only = stale_only
+        self.fingerprint_hash = config.fingerprint_hash
+        self.reuse_melodic = config.reuse_melodic
+        self.sweep = [den for den in config.sweep if den]
+        self.icaPath = config.icaPath
+        self.python = config.python
+        self.ov = overwrite
+        self.status = status
+        self.scheduler = scheduler(config.resources)
+        self.journal = job_journal(config.journal_path)
+        self.model = runtime_model(self.journal)
+        self.metrics = batch_metrics(self.model, self.scheduler.max_jobs, config.metrics_path, config.metrics_interval)
+        self.journal.on_write = self.metrics.update
+        self.summary = batch_summary(Path(config.batch_dir) / f'batch_{time.strftime("%Y%m%d_%H%M%S")}_{os.getpid()}.csv')
+        self.max_retries = config.max_retries
+        self.state = 'running'          # 'paused', 'draining' or 'cancelled' when told so
+        self.control = threading.Condition()
+        self.procs = set()              # running ICA-AROMA processes
+        self.killer = None              # timer killing jobs still running after a cancel's grace period
+        self.scratch = None             # local staging of job outputs, see run_staged
+        if config.resources.get('scratch_dir'):
+            try:
+                self.scratch = scratch_space(config.resources['scratch_dir'], config.resources.get('scratch_gb'))
+            except OSError as e:
+                print(f'Scratch directory not usable, writing outputs to the database: {e}')
+        # self.aux_args=[]
+        user_options = config.user_options
+        self.aux_args=['-dim',user_options[1],'-den',user_options[2]]
+        if user_options[0]!='': self.aux_args.extend(['-tr',user_options[0]])
+        if self.ov == 1: self.aux_args.append("-overwrite")
+
+    def report(self, record, msg):
+        if self.status is not None: self.status(record, msg)
+
+    # Pause stops new jobs from starting until unpause; drain lets running jobs finish and starts no more;
+    # cancel also terminates the running jobs' process groups and removes their partial output folders
+    def pause(self):
+        with self.control:
+            if self.state == 'running': self.state = 'paused'
+
+    def unpause(self):
+        with self.control:
+            if self.state == 'paused': self.state = 'running'
+            self.control.notify_all()
+
+    def drain(self):
+        with self.control:
+            if self.state in ('running', 'paused'): self.state = 'draining'
+            self.control.notify_all()
+
+    def cancel(self, grace=10):
+        with self.control:
+            self.state = 'cancelled'
+            self.control.notify_all()
+            procs = list(self.procs)
+        for proc in procs:
+            self.signal_job(proc, signal.SIGTERM)
+        # whatever ignores SIGTERM is killed after the grace period; the timer does not keep the program running
+        if procs:
+            self.killer = threading.Timer(grace, self.kill_remaining)
+            self.killer.daemon = True
+            self.killer.start()
+
+    # .feat folders of the jobs running now; their output folders are being written
+    def busy_inputs(self):
+        with self.control:
+            return {proc.args[proc.args.index('-feat') + 1] for proc in self.procs}
+
+    def kill_remaining(self):
+        with self.control:
+            procs = list(self.procs)
+        for proc in procs:
+            self.signal_job(proc, signal.SIGKILL)
+
+    # jobs run in their own session, so the whole process group (MELODIC, fslmaths, ...) gets the signal
+    @staticmethod
+    def signal_job(proc, signum):
+        try:
+            os.killpg(proc.pid, signum)
+        except OSError:
+            pass            # already gone
+
+    # waits while paused; False once draining or cancelled
+    def admit(self):
+        with self.control:
+            while self.state == 'paused':
+                self.control.wait()
+            return self.state == 'running'
+
+    # runs one job, retrying a failure up to max_retries times (max_retries + 1 attempts in all, counting those of
+    # earlier batches); returns the last exit code, or None when the job was not started or was cancelled
+    def call_ICA(self, que):
+        args, record, need, attempt = que
+        # print(args)
+        self.report(record, 'Queued')
+        fingerprint = self.fingerprint(record, args)
+        if self.stale_only and os.path.isdir(record.outpath):
+            if appFuncs.read_fingerprint(record.outpath) == fingerprint:
+                self.journal.write(record, 'skipped')
+                self.report(record, 'Up to date')
+                return 0
+            if '-overwrite' not in args: args = args + ['-overwrite']
+        # ICA-AROMA refuses an existing output folder without -overwrite (and exits 0), so it is not started at all
+        if os.path.isdir(record.outpath) and '-overwrite' not in args:
+            self.journal.write(record, 'skipped')
+            self.report(record, 'Already processed')
+            return 0
+        aside = None
+        # resumed args may carry an earlier batch's decomposition set aside, which is looked for again below, as it
+        # may have gone back into the output folder since
+        if '-md' in args[:-1] and Path(args[args.index('-md') + 1]) == self.aside_path(record.outpath):
+            at = args.index('-md')
+            args = args[:at] + args[at + 2:]
+        while True:
+            attempt += 1
+            self.scheduler.acquire(need)
+            try:
+                if not self.admit():
+                    # the journal still has the job as queued (or failed), so resume will run it
+                    self.report(record, 'Not started')
+                    return None
+                # an output about to be overwritten may hold a decomposition this job can reuse; a staged job leaves
+                # the output folder alone until it succeeds, so it reads the decomposition where it is
+                if self.reuse_melodic and '-overwrite' in args and '-md' not in args:
+                    melodic = self.set_aside_melodic(record.outpath, fingerprint, move=not self.scratch)
+                    if melodic is not None:
+                        args = args + ['-md', str(melodic)]
+                        if melodic == self.aside_path(record.outpath): aside = melodic
+                self.report(record, 'Processing...')
+                self.journal.write(record, 'running', attempt=attempt, args=args)
+                existed = os.path.isdir(record.outpath)
+                code, usage = self.run_staged(args, record, attempt) if self.scratch else self.run_job(args, record, attempt)
+            finally:
+                self.scheduler.release(need)
+            if code != 0 and self.state == 'cancelled':
+                # a staged job has not touched the output folder
+                if 'scratch' not in usage: self.remove_partial(record, args, existed)
+                if aside is not None:
+                    self.restore_melodic(record.outpath, aside)
+                    self.mark_melodic(record.outpath, fingerprint)
+                # the log joins an output folder that is left; without one it would stay behind in the session folder
+                if os.path.isdir(record.outpath):
+                    usage['log'] = str(self.keep_log(record.outpath))
+                else:
+                    try:
+                        os.remove(self.log_path(record.outpath))
+                    except OSError:
+                        pass
+                self.summary.write(record, usage)
+                self.journal.write(record, 'cancelled', args=args, **usage)
+                record.read_output()
+                record.usage = usage
+                self.report(record, 'Cancelled')
+                return None
+            final = code == 0 or attempt > self.max_retries
+            # retries with -overwrite remove the output folder, so the log joins it only once the job is settled
+            if final: usage['log'] = str(self.keep_log(record.outpath))
+            self.summary.write(record, usage)
+            if code == 0 and existed and '-overwrite' not in args:
+                # the folder appeared after the check above: ICA-AROMA refused it and exited 0 without any work,
+                # so it gets no fingerprint and is not counted as done
+                self.journal.write(record, 'skipped', **usage)
+                record.read_output()
+                record.usage = usage
+                self.report(record, 'Already processed')
+                return code
+            if code == 0:
+                if aside is not None: self.restore_melodic(record.outpath, aside)
+                self.own_melodic(record.outpath)
+                self.unmark_melodic(record.outpath)
+                self.write_fingerprint(record.outpath, fingerprint)
+                self.journal.write(record, 'done', **usage)
+                record.read_output()
+                record.usage = usage
+                self.report(record, 'Processed')
+                return code
+            self.journal.write(record, 'failed', args=args, **usage)
+            # e.g. classification failed after MELODIC finished: the next attempt or batch can reuse it
+            if 'scratch' not in usage: self.mark_melodic(record.outpath, fingerprint)
+            if final:
+                if aside is not None:
+                    self.restore_melodic(record.outpath, aside)
+                    self.mark_melodic(record.outpath, fingerprint)
+                record.read_output()
+                record.usage = usage
+                self.report(record, f'Failed (exit {code})')
+                return code
+            # a failed attempt may leave a partial output folder behind; only one this batch created may be overwritten
+            if not existed and os.path.isdir(record.outpath) and '-overwrite' not in args: args = args + ['-overwrite']
+
+    # what an output folder was made from: its run's inputs and the ICA-AROMA options, without the paths and
+    # -overwrite, which do not change the result
+    def fingerprint(self, record, args):
+        options, path = [], False
+        for arg in args[2:]:
+            if path:
+                path = False
+            elif arg in ('-feat', '-out', '-md'):
+                path = True
+            elif arg != '-overwrite':
+                options.append(arg)
+        return {'options': options, 'inputs': appFuncs.input_fingerprint(record.inpath, self.fingerprint_hash)}
+
+    # ICA-AROMA takes a MELODIC folder through -md when it has these; with stats/ in it, it links to the folder
+    melodic_files = ('melodic_IC.nii.gz', 'melodic_mix', 'melodic_FTmix')
+
+    @staticmethod
+    def melodic_complete(path):
+        return all(os.path.isfile(os.path.join(path, name)) for name in executor.melodic_files)
+
+    # the ICA-AROMA options that change the decomposition: all but -den
+    @staticmethod
+    def melodic_options(options):
+        pairs = dict(zip(options[::2], options[1::2]))
+        pairs.pop('-den', None)
+        return pairs
+
+    # where a decomposition waits beside its output folder while ICA-AROMA overwrites the folder
+    @staticmethod
+    def aside_path(outpath):
+        return Path(outpath).parent / f'.{Path(outpath).name}.melodic.ica'
+
+    # moves the melodic.ica of an output folder ICA-AROMA is about to overwrite beside it, with the fingerprint it
+    # was made with, if it was made from the same inputs and -dim/-tr; returns where it is, or None
+    # a folder left aside by an earlier attempt or batch is reused on the same condition; without move, a matching
+    # melodic.ica is returned where it is
+    def set_aside_melodic(self, outpath, fingerprint, move=True):
+        aside = self.aside_path(outpath)
+        def matches(made):
+            return (made is not None and made.get('inputs') == fingerprint['inputs']
+                    and self.melodic_options(made.get('options', [])) == self.melodic_options(fingerprint['options']))
+        if self.melodic_complete(aside):
+            return aside if matches(appFuncs.read_fingerprint(aside)) else None
+        melodic = Path(outpath)/'melodic.ica'
+        # marked by a failed attempt, or made by the job that wrote the output folder
+        made = appFuncs.read_fingerprint(melodic) or appFuncs.read_fingerprint(outpath)
+        if melodic.is_symlink() or not self.melodic_complete(melodic) or not matches(made): return None
+        if not move: return melodic
+        try:
+            shutil.rmtree(aside, ignore_errors=True)
+            os.rename(melodic, aside)
+        except OSError as e:
+            print(f'Could not set aside {melodic}: {e}')
+            return None
+        self.write_fingerprint(aside, made)
+        return aside
+
+    # a complete melodic.ica left by a failed attempt gets the fingerprint of that attempt, as the output folder has none
+    def mark_melodic(self, outpath, fingerprint):
+        melodic = Path(outpath)/'melodic.ica'
+        if not melodic.is_symlink() and self.melodic_complete(melodic): self.write_fingerprint(melodic, fingerprint)
+
+    # the fingerprint a decomposition was marked or set aside with, once the output folder has its own
+    @staticmethod
+    def unmark_melodic(outpath):
+        try:
+            os.remove(Path(outpath)/'melodic.ica'/'infobar_fingerprint.json')
+        except OSError:
+            pass
+
+    # puts a decomposition set aside back into the output folder, in place of the links ICA-AROMA made to it, or of
+    # a melodic.ica the job did not get to; without an output folder (a cancelled job's was removed) it stays aside
+    # for a later batch
+    def restore_melodic(self, outpath, aside):
+        melodic = Path(outpath)/'melodic.ica'
+        if not Path(outpath).is_dir() or not aside.is_dir(): return
+        try:
+            if melodic.is_symlink(): melodic.unlink()
+            if not melodic.exists():
+                os.rename(aside, melodic)
+                return
+            for entry in (melodic.iterdir() if melodic.is_dir() else ()):
+                if entry.is_symlink() and Path(os.path.realpath(entry)).parent == aside.resolve():
+                    os.replace(os.path.realpath(entry), entry)
+        except OSError as e:
+            print(f'Could not move {aside} back into {outpath}: {e}')
+            return
+        # a staged job has copied it already
+        shutil.rmtree(aside, ignore_errors=True)
+
+    # a sweep variant's melodic.ica links to the first variant's; it gets its own hard-linked copy, so rerunning
+    # the first variant does not break it
+    @staticmethod
+    def own_melodic(outpath):
+        melodic = Path(outpath)/'melodic.ica'
+        if not melodic.is_symlink(): return
+        source = Path(os.path.realpath(melodic))
+        def link(src, dst):
+            try:
+                os.link(src, dst)
+            except OSError:
+                shutil.copy2(src, dst)
+        try:
+            melodic.unlink()
+            shutil.copytree(source, melodic, copy_function=link)
+        except OSError as e:
+            print(f'Could not copy {source} into {outpath}: {e}')
+
+    @staticmethod
+    def write_fingerprint(outpath, fingerprint):
+        path = Path(outpath)/'infobar_fingerprint.json'
+        try:
+            with open(str(path) + '.tmp', 'w') as f:
+                json.dump(fingerprint, f, indent=1)
+            os.replace(str(path) + '.tmp', path)
+        except OSError as e:
+            print(f'Could not write fingerprint of {outpath}: {e}')
+
+    # log of a job while it runs: ICA-AROMA will not write into an existing output folder
+    @staticmethod
+    def log_path(outpath):
+        return Path(str(outpath) + '.infobar.log')
+
+    # runs one attempt with its output appended to the job's log; returns the exit code and a dict of wall time and
+    # the rusage of the job, which includes the FSL programs it waited for
+    def run_job(self, args, record, attempt):
+        import subprocess
+        usage = dict(attempt=attempt, code=127, started=time.strftime('%Y-%m-%d %H:%M:%S'), cost=record.job_cost())
+        log_path = self.log_path(record.outpath)
+        usage['log'] = str(log_path)
+        t1 = time.perf_counter()
+        try:
+            log = open(log_path, 'ab')
+        except OSError as e:
+            print(f'Could not open job log {log_path}: {e}')
+            log = None
+        try:
+            if log is not None:
+                log.write(f'==== {usage["started"]}  attempt {attempt}: {subprocess.list2cmdline(args)}\n'.encode())
+                log.flush()
+            proc = subprocess.Popen(self.scheduler.command(args), stdout=log,
+                                    stderr=subprocess.STDOUT if log is not None else None,
+                                    env=self.scheduler.environment(), start_new_session=True)
+            with self.control:
+                self.procs.add(proc)
+                cancelled = self.state == 'cancelled'
+            if cancelled: self.signal_job(proc, signal.SIGTERM)
+            try:
+                _, status, rusage = os.wait4(proc.pid, 0)
+            finally:
+                with self.control:
+                    self.procs.discard(proc)
+                    if not self.procs and self.killer is not None: self.killer.cancel()
+            usage['code'] = proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+            usage.update(user_s=round(rusage.ru_utime, 1), sys_s=round(rusage.ru_stime, 1),
+                         maxrss_mb=round(rusage.ru_maxrss / 1024, 1))
+        except OSError as e:
+            print(f'Could not start ICA-AROMA: {e}')
+            if log is not None: log.write(f'Could not start ICA-AROMA: {e}\n'.encode())
+        finally:
+            if log is not None: log.close()
+        usage['wall_s'] = round(time.perf_counter() - t1, 1)
+        return usage['code'], usage
+
+    # runs one attempt with its output in the scratch directory, so MELODIC's intermediate files stay off the
+    # database's filesystem; the finished output is copied next to the output folder and renamed into place
+    # the scratch copy is removed whatever the outcome
+    def run_staged(self, args, record, attempt):
+        # without -overwrite ICA-AROMA refuses an existing output folder, and staging must not replace it either
+        if os.path.isdir(record.outpath) and '-overwrite' not in args: return self.run_job(args, record, attempt)
+        need = self.scratch.need(record)
+        self.scratch.acquire(need)
+        try:
+            folder = self.scratch.folder()
+        except OSError as e:
+            self.scratch.release(need)
+            print(f'Could not stage in {self.scratch.path}, writing to the database: {e}')
+            # -overwrite would remove a decomposition read from the output folder before ICA-AROMA reads it
+            melodic = Path(record.outpath)/'melodic.ica'
+            if '-md' in args[:-1] and Path(args[args.index('-md') + 1]) == melodic:
+                at = args.index('-md')
+                args = args[:at] + args[at + 2:]
+            return self.run_job(args, record, attempt)
+        try:
+            stage = folder / Path(record.outpath).name
+            staged_args = list(args)
+            staged_args[staged_args.index('-out') + 1] = str(stage)
+            code, usage = self.run_job(staged_args, record, attempt)
+            usage['scratch'] = str(stage)
+            if code == 0:
+                try:
+                    self.publish(stage, record.outpath)
+                except OSError as e:
+                    print(f'Could not move {stage} to {record.outpath}: {e}')
+                    usage['code'] = code = 1
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+            self.scratch.release(need)
+        return code, usage
+
+    # files of a finished job that are not copied back from scratch: thresholded maps only used while classifying
+    scratch_skip = ('melodic_IC_thr*.nii.gz',)
+
+    # copies a finished output into a hidden folder beside outpath, then renames it to outpath, replacing an older
+    # output only at that point
+    def publish(self, stage, outpath):
+        outpath = Path(outpath)
+        incoming = outpath.parent / f'.{outpath.name}.infobar-incoming'
+        previous = outpath.parent / f'.{outpath.name}.infobar-previous'
+        shutil.rmtree(incoming, ignore_errors=True)
+        try:
+            shutil.copytree(stage, incoming, ignore=shutil.ignore_patterns(*self.scratch_skip))
+        except OSError:
+            shutil.rmtree(incoming, ignore_errors=True)
+            raise
+        if not outpath.exists():
+            os.rename(incoming, outpath)
+            return
+        shutil.rmtree(previous, ignore_errors=True)
+        os.rename(outpath, previous)
+        try:
+            os.rename(incoming, outpath)
+        except OSError:
+            os.rename(previous, outpath)
+            shutil.rmtree(incoming, ignore_errors=True)
+            raise
+        shutil.rmtree(previous, ignore_errors=True)
+
+    # output folder of a cancelled job; an output folder that was there before is only removed if the job had
+    # already started replacing it (-overwrite)
+    @staticmethod
+    def remove_partial(record, args, existed):
+        if existed and '-overwrite' not in args: return
+        shutil.rmtree(record.outpath, ignore_errors=True)
+
+    # moves the job log into the output folder as infobar.log, appending to an earlier one; returns where it is
+    def keep_log(self, outpath):
+        log_path = self.log_path(outpath)
+        target = Path(outpath) / 'infobar.log'
+        if not log_path.exists() or not Path(outpath).is_dir(): return log_path
+        try:
+            if target.exists():
+                with open(log_path, 'rb') as src, open(target, 'ab') as dst:
+                    shutil.copyfileobj(src, dst)
+                os.remove(log_path)
+            else:
+                os.replace(log_path, target)
+        except OSError as e:
+            print(f'Could not move job log into {outpath}: {e}')
+            return log_path
+        return target
+
+    # in a queue given by the caller (resume), a job followed by the sweep variants that reuse its decomposition
+    # carries them as a fifth item
+    def threader(self, que=None):
+        call = lambda job: self.call_sweep(job) if len(job) > 4 else self.call_ICA(job)
+        if que is None:
+            que=self.queue_prep()
+            if self.sweep: call = self.call_sweep
+        import concurrent.futures
+        self.metrics.start()
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.scheduler.max_jobs) as executor:
+                executor.map(call, que)
+        finally:
+            self.metrics.finish()
+
+    def job_args(self, inpath, outpath, den=None):
+        args = [self.python, str(self.icaPath), "-feat", str(inpath), "-out", str(outpath)] + self.aux_args
+        if den is not None: args[args.index('-den') + 1] = den
+        return args
+
+    def queue_prep(self):
+        que=[]
+        for row in self.fl:
+            if self.sweep:
+                variants = self.variants(row)
+                args = variants[0][1]
+                # every variant is journalled with its arguments, so resume can run those not reached
+                for variant, variant_args in variants:
+                    self.journal.write(variant, 'queued', attempt=0, args=variant_args)
+            else:
+                args = self.job_args(row.inpath, row.outpath)
+                self.journal.write(row, 'queued', attempt=0)
+            que.append([args, row, appFuncs.job_memory(row.job_cost()), 0])
+        return self.longest_first(que)
+
+    # (record, arguments) per den value of the sweep; the first writes the run's output folder and computes the
+    # decomposition, which the others are given with -md
+    def variants(self, row):
+        result = [(row, self.job_args(row.inpath, row.outpath, self.sweep[0]))]
+        melodic = Path(row.outpath)/'melodic.ica'
+        for den in self.sweep[1:]:
+            outpath = Path(f'{row.outpath}_{den}')
+            result.append((dataset_record(row.inpath, outpath), self.job_args(row.inpath, outpath, den) + ['-md', str(melodic)]))
+        return result
+
+    # runs the variants of a sweep one after another in the same thread; stops at the first that does not succeed,
+    # leaving the rest queued in the journal
+    def call_sweep(self, que):
+        args, record, need, attempt = que[:4]
+        if len(que) > 4:
+            followers = que[4]
+        else:
+            followers = [[variant_args, variant, need, 0] for variant, variant_args in self.variants(record)[1:]]
+        code = self.call_ICA(que[:4])
+        if code != 0: return code
+        for job in followers:
+            variant_args = job[0]
+            den = variant_args[variant_args.index('-den') + 1]
+            self.report(record, f'Processing {den}...')
+            code = self.call_ICA(job)
+            if code is None:
+                self.report(record, f'{den} not finished')
+                return code
+            if code != 0:
+                self.report(record, f'{den} failed (exit {code})')
+                return code
+        if followers: self.report(record, f'Processed ({len(followers) + 1} variants)')
+        return code
+
+    # the longest jobs go first, so no long job is left to run alone at the end of the batch
+    def longest_first(self, que):
+        return sorted(que, key=lambda job: self.model.seconds(job[1].job_cost()), reverse=True)
+
+    # expected (makespan, total job time) in seconds for processing records with this executor's job slots
+    def estimate(self, records):
+        durations = [self.model.seconds(record.job_cost()) for record in records]
+        return self.model.makespan(durations, self.scheduler.max_jobs), sum(durations)
+
+    # queue of unfinished jobs from the journal, rerun with their original arguments
+    # records of listed datasets (matched on output folder) are reused so their status is updated
+    def resume_prep(self):
+        pending, exhausted = self.journal.unfinished(self.max_retries)
+        displayed = {str(row.outpath): row for row in self.fl}
+        que=[]
+        for entry in pending:
+            row = displayed.get(entry['outpath']) or dataset_record(Path(entry['inpath']), Path(entry['outpath']))
+            args = entry.get('args') or self.job_args(entry['inpath'], entry['outpath'])
+            # the interrupted attempt may have left a partial output folder behind
+            if entry['state'] != 'queued' and '-overwrite' not in args: args = args + ['-overwrite']
+            # with its arguments, so a resume that is itself interrupted runs the same job
+            self.journal.write(row, 'queued', attempt=entry.get('attempt', 0), args=args, resumed=True)
+            que.append([args, row, appFuncs.job_memory(row.job_cost()), entry.get('attempt', 0)])
+        return self.longest_first(self.group_variants(que)), exhausted
+
+    # sweep variants whose -md points into the output folder of another job of the queue go after that job, in its
+    # slot, so none starts before the decomposition it reuses has been written
+    @staticmethod
+    def group_variants(que):
+        jobs = {str(job[1].outpath): job for job in que}
+        grouped = []
+        for job in que:
+            args = job[0]
+            md = Path(args[args.index('-md') + 1]) if '-md' in args[:-1] else None
+            base = jobs.get(str(md.parent)) if md is not None and md.name == 'melodic.ica' else None
+            if base is None or base is job:
+                grouped.append(job)
+            else:
+                if len(base) == 4: base.append([])
+                base[4].append(job)
+        return grouped
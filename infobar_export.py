@@ -0,0 +1,137 @@
+# INFOBAR Interface for batch processing ICA-AROMA
+# QC export: one row per run of a whole database, written as the runs are read
+# Copyright (C) 2020  Manish Anand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from pathlib import Path
+import csv, sys
+import concurrent.futures
+from infobar_core import scanner, appFuncs
+
+# column name and Parquet type of the exported table
+qc_columns = [('inpath', 'string'), ('outpath', 'string'), ('status', 'string'), ('abs', 'float64'),
+              ('rel', 'float64'), ('mean_fd', 'float64'), ('max_fd', 'float64'), ('fd_pct', 'float64'),
+              ('volumes', 'int64'), ('components', 'int64'), ('motion_components', 'int64'),
+              ('motion_fraction', 'float64'), ('postpath', 'string')]
+
+# QC measures of one run, read from its .feat and ICA-AROMA output folders; fd is its framewise displacement
+# summary, None without motion parameters
+def qc_row(record, fd=None):
+    record.read_output()
+    motion = appFuncs.headMotion_stats(record.inpath)
+    fd = fd or [None] * 3
+    volumes = components = motion_components = None
+    header = appFuncs.nifti_header(Path(record.inpath)/'filtered_func_data.nii.gz')
+    if header is not None and len(header[0]) >= 4: volumes = header[0][3]
+    if record.pvp:
+        # MELODIC's component maps hold one volume per component
+        header = appFuncs.nifti_header(Path(record.outpath)/'melodic.ica'/'melodic_IC.nii.gz')
+        if header is not None: components = header[0][3] if len(header[0]) >= 4 else 1
+        motion_components = len(record.motion_components())
+    return {'inpath': str(record.inpath), 'outpath': str(record.outpath), 'status': record.status(),
+            'abs': number(motion[0]), 'rel': number(motion[1]), 'mean_fd': fd[0], 'max_fd': fd[1], 'fd_pct': fd[2],
+            'volumes': volumes, 'components': components, 'motion_components': motion_components,
+            'motion_fraction': round(motion_components / components, 4) if components and motion_components is not None else None,
+            'postpath': str(record.postpath) if record.postpath else None}
+
+# QC rows of a chunk of runs, with the framewise displacement of all of them computed in one pass
+def qc_rows(records, fd_threshold=0.5):
+    fd = appFuncs.framewise_displacement([record.inpath for record in records], fd_threshold, workers=1)
+    return [qc_row(record, record_fd) for record, record_fd in zip(records, fd)]
+
+def number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+#  class for writing rows to CSV (or standard output for '-') or, for .parquet/.pq files, Parquet
+#  Parquet needs pyarrow; rows are written out in row groups of `batch`, so memory does not grow with the table
+class qc_writer:
+    def __init__(self, path, batch=1024):
+        self.path = str(path)
+        self.batch = batch
+        self.rows = []
+        self.count = 0
+        self.names = [name for name, kind in qc_columns]
+        if self.path.endswith(('.parquet', '.pq')):
+            try:
+                import pyarrow, pyarrow.parquet
+            except ImportError:
+                raise RuntimeError('Parquet export needs pyarrow (pip install pyarrow); use a .csv file instead')
+            self.pa = pyarrow
+            self.schema = pyarrow.schema([(name, getattr(pyarrow, kind)()) for name, kind in qc_columns])
+            self.parquet = pyarrow.parquet.ParquetWriter(self.path, self.schema)
+            self.file = None
+        else:
+            self.parquet = None
+            self.file = sys.stdout if self.path == '-' else open(self.path, 'w', newline='')
+            self.csv = csv.DictWriter(self.file, self.names)
+            self.csv.writeheader()
+
+    def write(self, row):
+        self.count += 1
+        if self.parquet is None:
+            self.csv.writerow(row)
+            if self.count % self.batch == 0: self.file.flush()
+            return
+        self.rows.append(row)
+        if len(self.rows) >= self.batch: self.flush()
+
+    def flush(self):
+        if self.parquet is not None and self.rows:
+            self.parquet.write_table(self.pa.Table.from_pylist(self.rows, schema=self.schema))
+            self.rows = []
+
+    def close(self):
+        self.flush()
+        if self.parquet is not None:
+            self.parquet.close()
+        elif self.file is sys.stdout:
+            self.file.flush()
+        else:
+            self.file.close()
+
+# walks the database and writes a QC row per run while the walk goes on; runs are read in chunks of `chunk`, and
+# at most `window` runs are read or waiting to be written at any time, so memory use does not depend on the size
+# of the database
+# progress(count) is called every `every` rows; returns the number of rows written
+def qc_export(root, dataset, path, config, processed_only=True, workers=8, window=256, progress=None, every=500,
+              chunk=64):
+    walk = scanner(root, dataset, config.scan_workers, None, config.prefeat_identifier, config.output_identifier)
+    writer = qc_writer(path)
+    def collect(done):
+        for future in done:
+            for row in future.result():
+                writer.write(row)
+                if progress is not None and writer.count % every == 0: progress(writer.count)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            inflight, records = set(), []
+            for record in walk.iterate():
+                # out_mtime is only set when the scan saw an output folder next to the run
+                if processed_only and record.out_mtime is None: continue
+                records.append(record)
+                if len(records) < chunk: continue
+                inflight.add(pool.submit(qc_rows, records, config.fd_threshold))
+                records = []
+                if len(inflight) * chunk >= window:
+                    done, inflight = concurrent.futures.wait(inflight, return_when=concurrent.futures.FIRST_COMPLETED)
+                    collect(done)
+            if records: inflight.add(pool.submit(qc_rows, records, config.fd_threshold))
+            collect(concurrent.futures.as_completed(inflight))
+    finally:
+        writer.close()
+    return writer.count
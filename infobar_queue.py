@@ -0,0 +1,211 @@
+# INFOBAR Interface for batch processing ICA-AROMA
+# Work queue on a shared filesystem, so INFOBAR workers on several machines can process one batch
+# Copyright (C) 2020  Manish Anand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from pathlib import Path
+import json, os, socket, threading, time, hashlib
+import concurrent.futures
+from infobar_core import executor, dataset_record, appFuncs
+
+#  class for the queue directory
+#  Every job is a JSON file that moves between pending/, running/, done/ and failed/ by atomic renames. A worker
+#  claims a job by renaming it into running/ under its own name; the file mtime is its lease, renewed while the job
+#  runs. Jobs whose lease expired (worker crashed, node rebooted) are renamed back to pending/ by any worker.
+#  Pending and running names start with the submit time in microseconds, zero-padded, so the oldest job is the
+#  first name in sorted order: <order>-<id>.json, and <order>-<id>.<worker>.json while claimed.
+class work_queue:
+    states = ('pending', 'running', 'done', 'failed')
+
+    def __init__(self, path, lease=600):
+        self.path = Path(path)
+        self.lease = lease
+        self.known = None       # state and file name of each id in the queue, listed at the first submit
+        self.order = 0
+        for state in self.states:
+            (self.path/state).mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def job_id(outpath):
+        return hashlib.sha1(os.path.abspath(outpath).encode()).hexdigest()[:16]
+
+    # the job id in a file name of any state
+    @staticmethod
+    def name_id(name):
+        return name.split('.')[0].rsplit('-', 1)[-1]
+
+    def jobs(self, state):
+        try:
+            return [name for name in os.listdir(self.path/state) if name.endswith('.json') and not name.startswith('.')]
+        except OSError:
+            return []
+
+    # writes a file completely before it appears under its final name
+    def publish(self, state, name, job):
+        tmp = self.path/state/f'.{name}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(job, f)
+        os.replace(tmp, self.path/state/name)
+
+    # adds a job unless one for the same output folder is already queued, running or finished
+    # paths are made absolute (ICA_AROMA.py, -feat, -out, -md), as workers run in other working directories
+    # the queue is listed once for all jobs submitted through this work_queue; the CLI and the GUI make one per batch
+    def submit(self, args, record, need, force=False):
+        inpath, outpath = os.path.abspath(record.inpath), os.path.abspath(record.outpath)
+        args = [os.path.abspath(arg) if i == 1 or args[i - 1] in ('-feat', '-out', '-md') else arg
+                for i, arg in enumerate(args)]
+        jid = self.job_id(outpath)
+        if self.known is None:
+            self.known = {self.name_id(name): (state, name) for state in self.states for name in self.jobs(state)}
+        if jid in self.known:
+            if not force: return False
+            # resubmitted: the new file takes the place of a job still pending
+            state, name = self.known[jid]
+            if state == 'pending':
+                try:
+                    os.unlink(self.path/state/name)
+                except FileNotFoundError:
+                    pass
+        # strictly increasing, so jobs of one batch keep the order they were submitted in
+        self.order = max(self.order + 1, time.time_ns() // 1000)
+        name = f'{self.order:017d}-{jid}.json'
+        self.publish('pending', name, {'id': jid, 'inpath': inpath, 'outpath': outpath,
+                                       'args': args, 'need': need, 'submitted': round(time.time(), 3)})
+        self.known[jid] = ('pending', name)
+        return True
+
+    # claims the oldest pending job for worker; returns (lease file, job) or None when nothing is pending
+    def claim(self, worker):
+        self.reclaim_expired()
+        for name in sorted(self.jobs('pending')):
+            lease = self.path/'running'/f'{name[:-5]}.{worker}.json'
+            # rename keeps the mtime, so the file is touched first: an old pending job would otherwise look like an
+            # expired lease to other workers the moment it is claimed
+            try:
+                os.utime(self.path/'pending'/name)
+                os.rename(self.path/'pending'/name, lease)
+            except FileNotFoundError:
+                continue        # another worker was faster
+            try:
+                with open(lease) as f:
+                    return lease, json.load(f)
+            except FileNotFoundError:
+                continue        # reclaimed by another worker all the same
+        return None
+
+    def renew(self, lease):
+        try:
+            os.utime(lease)
+        except FileNotFoundError:
+            pass                # lease was lost and the job reclaimed
+
+    def finish(self, lease, job, code, worker):
+        job.update(code=code, worker=worker, finished=round(time.time(), 3))
+        self.publish('done' if code == 0 else 'failed', f"{job['id']}.json", job)
+        try:
+            os.unlink(lease)
+        except FileNotFoundError:
+            pass
+
+    # gives a claimed job back, e.g. when its worker was cancelled before finishing it
+    def release(self, lease):
+        try:
+            os.rename(lease, self.path/'pending'/f"{lease.name.split('.')[0]}.json")
+        except FileNotFoundError:
+            pass
+
+    # returns jobs whose lease was not renewed in time to pending/
+    def reclaim_expired(self):
+        now = time.time()
+        for name in self.jobs('running'):
+            lease = self.path/'running'/name
+            if now - self.mtime(lease, now) > self.lease:
+                try:
+                    os.rename(lease, self.path/'pending'/f"{name.split('.')[0]}.json")
+                except FileNotFoundError:
+                    pass
+
+    @staticmethod
+    def mtime(path, default=0):
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return default
+
+    # job counts per state and the jobs each worker is running
+    def status(self):
+        counts = {state: len(self.jobs(state)) for state in self.states}
+        workers = {}
+        for name in self.jobs('running'):
+            worker = name.split('.')[1]
+            workers[worker] = workers.get(worker, 0) + 1
+        counts['workers'] = workers
+        return counts
+
+#  class for a worker process pulling jobs from a work_queue
+#  Runs as many jobs at once as the local scheduler allows, renewing the leases of the jobs it holds
+class queue_worker:
+    def __init__(self, queue, config, exit_when_empty=False, report=None, poll=10):
+        self.queue = queue
+        self.id = f"{socket.gethostname().replace('.', '_')}-{os.getpid()}"
+        self.executor = executor([], config, 0, None)
+        self.exit_when_empty = exit_when_empty
+        self.report = report or (lambda **event: None)
+        self.poll = poll
+        self.held = set()
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+
+    def run(self):
+        renewer = threading.Thread(target=self.renew_leases, daemon=True)
+        renewer.start()
+        slots = self.executor.scheduler.max_jobs
+        self.executor.metrics.start()
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=slots) as pool:
+                list(pool.map(lambda slot: self.slot(), range(slots)))
+        finally:
+            self.stop.set()
+            self.executor.metrics.finish()
+
+    def slot(self):
+        while not self.stop.is_set():
+            # pausing the executor holds the slot; draining or cancelling it ends the slot
+            if not self.executor.admit(): return
+            claimed = self.queue.claim(self.id)
+            if claimed is None:
+                if self.exit_when_empty: return
+                self.stop.wait(self.poll)
+                continue
+            lease, job = claimed
+            with self.lock: self.held.add(lease)
+            self.report(event='claimed', worker=self.id, inpath=job['inpath'])
+            record = dataset_record(Path(job['inpath']), Path(job['outpath']))
+            try:
+                code = self.executor.call_ICA([job['args'], record, job.get('need') or appFuncs.job_memory(record.job_cost()), 0])
+            finally:
+                with self.lock: self.held.discard(lease)
+            if code is None:
+                self.queue.release(lease)
+                self.report(event='released', worker=self.id, inpath=job['inpath'])
+                continue
+            self.queue.finish(lease, job, code, self.id)
+            self.report(event='finished', worker=self.id, inpath=job['inpath'], code=code)
+
+    def renew_leases(self):
+        while not self.stop.wait(self.queue.lease / 4):
+            with self.lock: held = list(self.held)
+            for lease in held:
+                self.queue.renew(lease)
@@ -0,0 +1,146 @@
+# INFOBAR Interface for batch processing ICA-AROMA
+# Output verification: finds ICA-AROMA output folders left incomplete by crashed or killed jobs
+# Copyright (C) 2020  Manish Anand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from pathlib import Path
+import gzip, os, struct, zlib
+import concurrent.futures
+from infobar_core import appFuncs, executor
+
+# denoised images ICA-AROMA writes for each -den value
+denoised_names = {'nonaggr': ['nonaggr'], 'aggr': ['aggr'], 'both': ['nonaggr', 'aggr'], 'no': []}
+
+#  class for checking ICA-AROMA output folders
+#  An output is broken when melodic.ica or classified_motion_ICs.txt is missing, or when one of its
+#  denoised_func_data images is missing, has a header that cannot be read, has other dimensions than the run's
+#  filtered_func_data, or does not hold as much data as its header says. The length check reads only the gzip trailer, whose last
+#  4 bytes hold the uncompressed size (ISIZE); with deep, every image is decompressed instead, which also catches
+#  corrupted data through the gzip CRC but reads the whole file.
+class output_verifier:
+    def __init__(self, den='nonaggr', deep=False):
+        self.den = den          # -den assumed for outputs without a fingerprint to tell
+        self.deep = deep
+
+    # list of problems of a record's output folder, empty when it is complete
+    def check(self, record):
+        out = Path(record.outpath)
+        problems = []
+        if not (out/'melodic.ica').is_dir(): problems.append('melodic.ica missing')
+        if not (out/'classified_motion_ICs.txt').is_file(): problems.append('classified_motion_ICs.txt missing')
+        source = appFuncs.nifti_header(Path(record.inpath)/'filtered_func_data.nii.gz')
+        for name in self.denoised(out):
+            path = out/f'denoised_func_data_{name}.nii.gz'
+            problem = self.image(path, source)
+            if problem is not None: problems.append(f'{path.name} {problem}')
+        return problems
+
+    # denoised images the output should hold: those of the -den it was made with, as recorded in its fingerprint,
+    # otherwise those present, or those of the configured -den when there are none
+    def denoised(self, out):
+        options = made_with(out)
+        if '-den' in options[:-1]: return denoised_names.get(options[options.index('-den') + 1], [])
+        try:
+            with os.scandir(out) as it:
+                names = sorted(entry.name[len('denoised_func_data_'):-len('.nii.gz')] for entry in it
+                               if entry.name.startswith('denoised_func_data_') and entry.name.endswith('.nii.gz'))
+        except OSError:
+            names = []
+        return names or denoised_names.get(self.den, [])
+
+    # what is wrong with one image, None if nothing
+    def image(self, path, source):
+        header = appFuncs.nifti_header(path, offset=True)
+        if header is None: return 'unreadable' if os.path.exists(path) else 'missing'
+        dims, bitpix, offset = header
+        if source is not None and dims[:4] != source[0][:4]:
+            return f'has dimensions {dims[:4]}, the input {source[0][:4]}'
+        size = int(offset)
+        voxels = 1
+        for n in dims: voxels *= max(n, 1)
+        size += voxels * bitpix // 8
+        if self.deep: return self.read_all(path, size)
+        try:
+            with open(path, 'rb') as f:
+                f.seek(-4, os.SEEK_END)
+                isize = struct.unpack('<I', f.read(4))[0]
+        except OSError:
+            return 'incomplete'
+        if isize != size % 2**32: return 'incomplete'
+        return None
+
+    @staticmethod
+    def read_all(path, size):
+        read = 0
+        try:
+            with gzip.open(path, 'rb') as f:
+                while True:
+                    chunk = f.read(2**22)
+                    if not chunk: break
+                    read += len(chunk)
+        except EOFError:
+            return 'incomplete'
+        except (OSError, zlib.error) as e:
+            return f'corrupt ({e})'
+        if read != size: return 'incomplete'
+        return None
+
+# ICA-AROMA options an output folder was made with, from its fingerprint; empty when it has none
+def made_with(outpath):
+    fingerprint = appFuncs.read_fingerprint(outpath)
+    return fingerprint.get('options', []) if isinstance(fingerprint, dict) else []
+
+# checks the output folders of records in parallel; at most `window` checks are waiting at a time, so tens of
+# thousands of runs take no more memory than a few hundred. Records without an output folder, and those with a job
+# running in the active batch (an executor), are left out; a job the journal still shows as running after a crash
+# is checked like any other. Sets record.broken; returns the checked and broken records
+# progress(count) is called every `every` records checked
+def verify_outputs(records, conf, deep=False, workers=8, window=256, progress=None, every=500, active=None):
+    verifier = output_verifier(conf.user_options[2] or conf.default_options[2], deep)
+    busy = active.busy_inputs() if active is not None else set()
+    checked, broken = [], []
+    def collect(done):
+        for future in done:
+            record = futures.pop(future)
+            record.broken = future.result()
+            checked.append(record)
+            if record.broken: broken.append(record)
+            if progress is not None and len(checked) % every == 0: progress(len(checked))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {}
+        for record in records:
+            if not os.path.isdir(record.outpath) or str(record.inpath) in busy: continue
+            futures[pool.submit(verifier.check, record)] = record
+            if len(futures) >= window:
+                done = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)[0]
+                collect(done)
+        collect(concurrent.futures.as_completed(list(futures)))
+    return checked, broken
+
+# queues broken outputs for reprocessing: each is journalled as queued with -overwrite, so Resume (or the resume
+# command) reruns it with the options it was made with, and its fingerprint is removed, so it no longer counts as
+# up to date
+def requeue(broken, conf):
+    builder = executor(broken, conf, 1, None)
+    for record in broken:
+        args = builder.job_args(record.inpath, record.outpath)
+        options = made_with(record.outpath)
+        if options: args = args[:6] + options + ['-overwrite']
+        try:
+            os.remove(Path(record.outpath)/'infobar_fingerprint.json')
+        except OSError:
+            pass
+        builder.journal.write(record, 'queued', attempt=0, args=args, broken=record.broken)
+    return len(broken)
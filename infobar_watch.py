@@ -0,0 +1,199 @@
+# INFOBAR Interface for batch processing ICA-AROMA
+# Watches the run and output folders of listed datasets and refreshes only the datasets that changed
+# Copyright (C) 2020  Manish Anand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from pathlib import Path
+import ctypes, ctypes.util, errno, os, select, struct, threading, time
+from infobar_core import appFuncs
+
+#  class for Linux inotify through the C library
+#  Raises OSError when inotify is not available (other systems, or no watches left), so callers can fall back to polling
+class inotify:
+    IN_MODIFY, IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO = 0x2, 0x8, 0x40, 0x80
+    IN_CREATE, IN_DELETE, IN_DELETE_SELF, IN_MOVE_SELF = 0x100, 0x200, 0x400, 0x800
+    IN_Q_OVERFLOW, IN_IGNORED, IN_ONLYDIR = 0x4000, 0x8000, 0x01000000
+    IN_NONBLOCK, IN_CLOEXEC = 0o4000, 0o2000000
+    event = struct.Struct('iIII')
+
+    def __init__(self):
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            for call in ('inotify_init1', 'inotify_add_watch', 'inotify_rm_watch'): getattr(self.libc, call)
+        except (OSError, AttributeError, TypeError):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0: self.error('inotify_init1')
+
+    def error(self, call):
+        code = ctypes.get_errno()
+        raise OSError(code, f'{call}: {os.strerror(code)}')
+
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(str(path)), mask | self.IN_ONLYDIR)
+        if wd < 0: self.error('inotify_add_watch')
+        return wd
+
+    def rm_watch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    # (wd, mask, name) of the events that arrive within timeout seconds
+    def read(self, timeout):
+        if not select.select([self.fd], [], [], timeout)[0]: return []
+        try:
+            data = os.read(self.fd, 256 * 1024)
+        except BlockingIOError:
+            return []
+        events, position = [], 0
+        while position < len(data):
+            wd, mask, cookie, length = self.event.unpack_from(data, position)
+            position += self.event.size
+            name = os.fsdecode(data[position:position + length].rstrip(b'\0'))
+            position += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+#  class for keeping listed datasets current while other jobs or people process them
+#  Per dataset it watches the folder holding the run and its output folder (for the output folder appearing or
+#  disappearing), the output folder (post-stats .feat added, ICA-AROMA files written) and the run's mc/ folder
+#  (motion re-estimated). Events are collected until the folders are quiet for `settle` seconds, then only the
+#  datasets concerned are re-read and passed to on_change(records) from the watcher thread.
+#  Without inotify, or when it runs out of watches, the same folders are polled for mtime changes every `interval`.
+class dataset_watcher:
+    folder_mask = inotify.IN_CREATE | inotify.IN_DELETE | inotify.IN_MOVED_FROM | inotify.IN_MOVED_TO
+    file_mask = folder_mask | inotify.IN_CLOSE_WRITE
+
+    def __init__(self, records, on_change, fd_threshold=0.5, interval=30, settle=1.0):
+        self.records = list(records)
+        self.on_change = on_change
+        self.fd_threshold = fd_threshold
+        self.interval = interval
+        self.settle = settle
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.mode = None            # 'inotify' or 'polling' once running
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        try:
+            notifier = inotify()
+        except OSError:
+            self.poll()
+            return
+        try:
+            self.watch(notifier)
+        except OSError:
+            # typically ENOSPC: fs.inotify.max_user_watches is too low for this many folders
+            notifier.close()
+            self.poll()
+            return
+        notifier.close()
+
+    def watch(self, notifier):
+        self.mode = 'inotify'
+        self.targets = {}           # wd -> list of (kind, record)
+        for record in self.records:
+            self.add(notifier, Path(record.outpath).parent, 'parent', record, self.folder_mask)
+            self.add(notifier, Path(record.inpath)/'mc', 'mc', record, self.file_mask)
+            if record.pvp: self.add(notifier, record.outpath, 'out', record, self.file_mask)
+        changes = {}
+        deadline = None
+        while not self.stop_event.is_set():
+            for wd, mask, name in notifier.read(0.5):
+                if mask & notifier.IN_Q_OVERFLOW:
+                    for record in self.records: changes.setdefault(record, set()).update(('out', 'mc'))
+                elif mask & notifier.IN_IGNORED:
+                    self.targets.pop(wd, None)      # folder removed
+                else:
+                    self.event(notifier, wd, mask, name, changes)
+                deadline = time.monotonic() + self.settle
+            if changes and time.monotonic() >= deadline:
+                self.refresh(changes)
+                changes = {}
+
+    def add(self, notifier, path, kind, record, mask):
+        try:
+            wd = notifier.add_watch(path, mask)
+        except OSError as e:
+            if e.errno in (errno.ENOENT, errno.ENOTDIR, errno.EACCES): return
+            raise
+        self.targets.setdefault(wd, []).append((kind, record))
+
+    def event(self, notifier, wd, mask, name, changes):
+        for kind, record in self.targets.get(wd, ()):
+            if kind == 'parent':
+                # only the dataset's own output folder matters in the shared session folder
+                if name != Path(record.outpath).name: continue
+                if mask & (notifier.IN_CREATE | notifier.IN_MOVED_TO):
+                    self.add(notifier, record.outpath, 'out', record, self.file_mask)
+                changes.setdefault(record, set()).add('out')
+            elif kind == 'out':
+                changes.setdefault(record, set()).add('out')
+            elif name.endswith(('.rms', '.par')):
+                changes.setdefault(record, set()).add('mc')
+
+    # mtimes that change whenever the output folder or the motion estimates change; None for missing files
+    @staticmethod
+    def snapshot(record):
+        state = []
+        for path in (record.outpath, Path(record.inpath)/'mc'/'prefiltered_func_data_mcf_abs_mean.rms',
+                     Path(record.inpath)/'mc'/'prefiltered_func_data_mcf.par'):
+            try:
+                state.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                state.append(None)
+        return state
+
+    def poll(self):
+        self.mode = 'polling'
+        known = {record: self.snapshot(record) for record in self.records}
+        while not self.stop_event.wait(self.interval):
+            changes = {}
+            for record in self.records:
+                state = self.snapshot(record)
+                if state == known[record]: continue
+                kinds = changes.setdefault(record, set())
+                if state[0] != known[record][0]: kinds.add('out')
+                if state[1:] != known[record][1:]: kinds.add('mc')
+                known[record] = state
+            if changes: self.refresh(changes)
+
+    # re-reads the datasets that saw events and reports those whose state or motion actually changed
+    def refresh(self, changes):
+        changed = []
+        before = {record: (record.pvp, record.pop, str(record.postpath), list(record.motion), record.fd)
+                  for record in changes}
+        moved = [record for record, kinds in changes.items() if 'mc' in kinds]
+        for record, kinds in changes.items():
+            if 'out' in kinds: record.read_output()
+        paths = [record.inpath for record in moved]
+        for record, motion, fd in zip(moved, appFuncs.headMotion_batch(paths),
+                                      appFuncs.framewise_displacement(paths, self.fd_threshold)):
+            record.motion = motion
+            record.fd = fd
+        for record in changes:
+            if (record.pvp, record.pop, str(record.postpath), list(record.motion), record.fd) != before[record]:
+                changed.append(record)
+        if changed: self.on_change(changed)
@@ -0,0 +1,46 @@
+# INFOBAR Interface for batch processing ICA-AROMA
+# Test fixtures: a settings.json running the ICA-AROMA stand-in, and synthetic databases
+# Copyright (C) 2020  Manish Anand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from pathlib import Path
+import json, sys
+import pytest
+
+root = Path(__file__).resolve().parent.parent
+sys.path[:0] = [str(root), str(root/'benchmarks')]
+
+from infobar_core import config, search
+from make_database import make_database
+
+# settings in a folder of their own, so the journal, index and batch tables of a test stay in it
+@pytest.fixture
+def conf(tmp_path):
+    settings = {'icaPath': str(root/'benchmarks'/'ICA_AROMA_stub.py'), 'python': sys.executable,
+                'defaults': ['', '0', 'nonaggr'], 'user': ['', '0', 'nonaggr'],
+                'prefeat_identifier': '_pre_AROMA', 'output_identifier': '_AROMA_Output',
+                'scan_workers': 2, 'resources': {'max_jobs': 2}, 'max_retries': 1}
+    path = tmp_path/'settings'/'settings.json'
+    path.parent.mkdir()
+    path.write_text(json.dumps(settings))
+    return config(path)
+
+# returns the records of a database of `subjects` unprocessed rest runs
+@pytest.fixture
+def database(tmp_path, conf):
+    def make(subjects):
+        make_database(tmp_path/'db', subjects, ['rest'], processed=0, invalid=0, volumes=20)
+        return search(str(tmp_path/'db'), 'rest', '', conf)
+    return make
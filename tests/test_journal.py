@@ -0,0 +1,79 @@
+# INFOBAR Interface for batch processing ICA-AROMA
+# Tests of the job journal and resuming a batch from it
+# Copyright (C) 2020  Manish Anand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from pathlib import Path
+import os
+from infobar_core import job_journal, dataset_record, executor
+
+def job(name):
+    return dataset_record(Path(f'/db/{name}_pre_AROMA.feat'), Path(f'/db/{name}_AROMA_Output'))
+
+def test_unfinished(tmp_path):
+    journal = job_journal(tmp_path/'journal.jsonl')
+    for name in 'abcdef': journal.write(job(name), 'queued', attempt=0)
+    journal.write(job('a'), 'done')
+    journal.write(job('b'), 'skipped')
+    journal.write(job('c'), 'failed', attempt=2)
+    journal.write(job('d'), 'failed', attempt=1)
+    journal.write(job('e'), 'running', attempt=1)
+    # a crash while writing leaves a torn last line
+    with open(tmp_path/'journal.jsonl', 'a') as f: f.write('{"time": 1, "inpath": "/db/f_pre')
+    pending, exhausted = journal.unfinished(max_retries=1)
+    assert [entry['outpath'] for entry in pending] == ['/db/d_AROMA_Output', '/db/e_AROMA_Output', '/db/f_AROMA_Output']
+    assert [entry['outpath'] for entry in exhausted] == ['/db/c_AROMA_Output']
+
+def test_resume_prep(conf, database):
+    records = database(3)
+    queued, interrupted, finished = records
+    journal = job_journal(conf.journal_path)
+    builder = executor(records, conf, 0, None)
+    for r in records: journal.write(r, 'queued', attempt=0, args=builder.job_args(r.inpath, r.outpath))
+    journal.write(interrupted, 'running', attempt=1, args=builder.job_args(interrupted.inpath, interrupted.outpath))
+    journal.write(finished, 'done')
+    que, exhausted = executor([], conf, 0, None).resume_prep()
+    jobs = {str(entry[1].outpath): entry for entry in que}
+    assert sorted(jobs) == sorted([str(queued.outpath), str(interrupted.outpath)]) and exhausted == []
+    # the interrupted attempt may have left a partial output folder, which only -overwrite replaces
+    assert '-overwrite' not in jobs[str(queued.outpath)][0]
+    assert '-overwrite' in jobs[str(interrupted.outpath)][0] and jobs[str(interrupted.outpath)][3] == 1
+    # journalled again with their arguments, so an interrupted resume runs the same jobs
+    last = job_journal(conf.journal_path).last_states()
+    assert last[str(interrupted.outpath)]['state'] == 'queued' and last[str(interrupted.outpath)]['resumed']
+    assert '-overwrite' in last[str(interrupted.outpath)]['args']
+
+def test_resume_after_failures_and_crash(conf, database, monkeypatch):
+    records = database(4)
+    monkeypatch.setenv('INFOBAR_STUB_FAIL', '1')
+    executor(records, conf, 0, None).threader()
+    states = job_journal(conf.journal_path).last_states()
+    assert [states[str(r.outpath)]['state'] for r in records] == ['failed'] * 4
+    assert all(states[str(r.outpath)]['attempt'] == conf.max_retries + 1 for r in records)
+    # used up their retries: resume leaves them out until max_retries is raised
+    que, exhausted = executor([], conf, 0, None).resume_prep()
+    assert que == [] and len(exhausted) == 4
+    # a job that was running when INFOBAR stopped, with the partial output it left
+    job_journal(conf.journal_path).write(records[0], 'running', attempt=1)
+    monkeypatch.delenv('INFOBAR_STUB_FAIL')
+    conf.max_retries = 5
+    resumer = executor([], conf, 0, None)
+    que, exhausted = resumer.resume_prep()
+    assert len(que) == 4 and exhausted == []
+    resumer.threader(que)
+    states = job_journal(conf.journal_path).last_states()
+    assert [states[str(r.outpath)]['state'] for r in records] == ['done'] * 4
+    assert all(os.path.isfile(Path(r.outpath)/'classified_motion_ICs.txt') for r in records)
+    assert executor([], conf, 0, None).resume_prep() == ([], [])
@@ -0,0 +1,70 @@
+# INFOBAR Interface for batch processing ICA-AROMA
+# Tests of the filter query language
+# Copyright (C) 2020  Manish Anand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from pathlib import Path
+import pytest
+from infobar_core import record_query, dataset_record, apply_filters
+import infobar_cli
+
+def record(path, motion=('0.5', '0.1'), fd=(0.2, 0.9, 10.0), pvp=0, message=None, outlier=False):
+    r = dataset_record(Path(path), Path(path + '_out'))
+    r.motion, r.fd, r.pvp, r.message, r.outlier = list(motion), fd, pvp, message, outlier
+    return r
+
+records = [record('/db/sub01/rest'), record('/db/sub02/rest', motion=('2.0', '0.4'), pvp=1),
+           record('/db/sub03/task', fd=None, message='Failed (exit 1)'), record('/db/sub04/processed_rest', outlier=True)]
+
+def matches(query):
+    return [str(r.inpath).split('/')[2] for r in record_query(query).filter(records)]
+
+@pytest.mark.parametrize('query, expected', [
+    ('sub01;sub03', ['sub01', 'sub03']),
+    ('rest and sub0?', ['sub01', 'sub02', 'sub04']),
+    ('rest sub02', ['sub02']),
+    ('abs > 1.5', ['sub02']),
+    ('abs >= 0.5 and not processed', ['sub01', 'sub03', 'sub04']),
+    ('rest and (rel >= 0.3 or failed)', ['sub02']),
+    ('fd < 0.5', ['sub01', 'sub02', 'sub04']),      # runs without FD compare as NaN
+    ('outlier or failed', ['sub03', 'sub04']),
+    ('"processed"', ['sub04']),                     # quoted keywords are path keywords
+    ('NOT rest', ['sub03']),                        # keywords in any case, paths as written
+    ('Rest', []),
+])
+def test_query(query, expected):
+    assert matches(query) == expected
+
+@pytest.mark.parametrize('query', ['sub01;', ';sub01', 'sub01;;sub02', '(sub01;)'])
+def test_empty_alternatives_are_left_out(query):
+    assert 'sub01' in matches(query) and 'sub03' not in matches(query)
+
+def test_only_separators_match_everything():
+    assert len(apply_filters(records, ';')) == len(records)
+
+def test_path_only_queries_need_no_data():
+    assert not record_query('sub01;rest and not task').uses_data
+    assert record_query('sub01 or failed').uses_data
+
+@pytest.mark.parametrize('query', ['abs >', 'abs > x', '(rest', 'rest)', 'sub01 or', '()', 'rest !'])
+def test_unreadable_query(query):
+    with pytest.raises(ValueError):
+        record_query(query)
+
+def test_cli_reports_unreadable_filters(capsys):
+    with pytest.raises(SystemExit) as exit:
+        infobar_cli.main(['scan', '--root', '/nonexistent', '--filters', 'abs > x'])
+    assert exit.value.code == 2
+    assert '--filters' in capsys.readouterr().err
@@ -0,0 +1,87 @@
+# INFOBAR Interface for batch processing ICA-AROMA
+# Tests of the shared work queue: several workers, and leases of workers that stopped
+# Copyright (C) 2020  Manish Anand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os, threading, time
+from infobar_core import executor
+from infobar_queue import work_queue, queue_worker
+
+def submit_all(queue, records, conf):
+    builder = executor(records, conf, 0, None)
+    return sum(queue.submit(builder.job_args(r.inpath, r.outpath), r, 2**20) for r in records)
+
+def test_workers_claim_each_job_once(tmp_path, conf, database):
+    records = database(12)
+    queue = work_queue(tmp_path/'queue')
+    assert submit_all(queue, records, conf) == 12
+    events, lock = [], threading.Lock()
+    def report(**event):
+        with lock: events.append(event)
+    workers = [queue_worker(work_queue(tmp_path/'queue'), conf, exit_when_empty=True, report=report) for _ in range(3)]
+    for n, worker in enumerate(workers): worker.id += f'_{n}'
+    threads = [threading.Thread(target=worker.run) for worker in workers]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join(60)
+    claimed = [event['inpath'] for event in events if event['event'] == 'claimed']
+    assert sorted(claimed) == sorted(str(r.inpath) for r in records)
+    assert [event['code'] for event in events if event['event'] == 'finished'] == [0] * 12
+    status = queue.status()
+    assert (status['pending'], status['running'], status['done'], status['failed']) == (0, 0, 12, 0)
+    assert all(os.path.isdir(r.outpath) for r in records)
+
+def test_submit_skips_queued_jobs(tmp_path, conf, database):
+    records = database(3)
+    assert submit_all(work_queue(tmp_path/'queue'), records, conf) == 3
+    assert submit_all(work_queue(tmp_path/'queue'), records, conf) == 0
+    # forced, each job takes the place of its pending file
+    builder = executor(records, conf, 0, None)
+    queue = work_queue(tmp_path/'queue')
+    assert all(queue.submit(builder.job_args(r.inpath, r.outpath), r, 2**20, force=True) for r in records)
+    assert queue.status()['pending'] == 3
+
+def test_claim_takes_oldest_first(tmp_path, conf, database):
+    records = database(4)
+    queue = work_queue(tmp_path/'queue')
+    submit_all(queue, records, conf)
+    claimed = [queue.claim('w')[1]['inpath'] for _ in records]
+    assert claimed == [str(r.inpath) for r in records]
+    assert queue.claim('w') is None
+
+def test_expired_lease_is_reclaimed(tmp_path, conf, database):
+    records = database(1)
+    submit_all(work_queue(tmp_path/'queue'), records, conf)
+    lease, job = work_queue(tmp_path/'queue').claim('stopped')
+    # a worker that renews in time keeps the job
+    assert work_queue(tmp_path/'queue', lease=600).claim('other') is None
+    old = time.time() - 1000
+    os.utime(lease, (old, old))
+    lease2, job2 = work_queue(tmp_path/'queue', lease=600).claim('other')
+    assert job2['id'] == job['id'] and lease2.name.endswith('.other.json')
+    assert not lease.exists()
+    # the stopped worker finding out later does not bring the job back
+    work_queue(tmp_path/'queue').renew(lease)
+    assert work_queue(tmp_path/'queue').status()['running'] == 1
+
+def test_worker_finishes_reclaimed_job(tmp_path, conf, database):
+    records = database(2)
+    submit_all(work_queue(tmp_path/'queue'), records, conf)
+    lease, job = work_queue(tmp_path/'queue').claim('stopped')
+    old = time.time() - 1000
+    os.utime(lease, (old, old))
+    events = []
+    queue_worker(work_queue(tmp_path/'queue'), conf, exit_when_empty=True, report=lambda **event: events.append(event)).run()
+    assert sorted(event['inpath'] for event in events if event['event'] == 'finished') == sorted(str(r.inpath) for r in records)
+    assert work_queue(tmp_path/'queue').status()['done'] == 2